@@ -0,0 +1,674 @@
+import argparse
+import json
+import os
+import pickle
+import re
+import subprocess
+import tempfile
+import time
+import types
+import wave
+
+import cv2
+import numpy as np
+import pysubs2
+
+from main import (HeuristicMomentEngine, KeyframeIndex, ResizeFrameRenderer, S3TransferManager, SourceAudio,
+                  cut_segment, frame_energy_db, make_s3_client, plan_transcription_chunks, probe_video,
+                  speech_regions, select_speaker_per_frame, serialize_transcript, snap_moments_to_words,
+                  subtitle_engine, Transcript)
+
+
+def _time_call(fn, repeat):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def synthetic_tracks(num_frames=1500, num_tracks=4, seed=0):
+    """Tracks/scores shaped like Columbia_test.py's tracks.pckl and scores.pckl."""
+    rng = np.random.default_rng(seed)
+    tracks, scores = [], []
+    for _ in range(num_tracks):
+        start = int(rng.integers(0, num_frames // 4))
+        end = int(rng.integers(num_frames // 2, num_frames))
+        frames = np.arange(start, end)
+        tracks.append({
+            "track": {"frame": frames},
+            "proc_track": {
+                "x": rng.uniform(200, 1700, len(frames)),
+                "y": rng.uniform(200, 900, len(frames)),
+                "s": rng.uniform(50, 200, len(frames)),
+            },
+        })
+        # ASD emits slightly fewer scores than frames for most tracks
+        scores.append(rng.normal(0.0, 1.5, len(frames) - int(rng.integers(0, 5))).round(1))
+    return tracks, scores
+
+
+def legacy_speaker_selection(tracks, scores, num_frames):
+    """The per-frame dict/max loop create_vertical_video used before vectorising."""
+    faces = [[] for _ in range(num_frames)]
+    for tidx, track in enumerate(tracks):
+        score_array = scores[tidx]
+        for fidx, frame in enumerate(track["track"]["frame"].tolist()):
+            slice_start = max(fidx - 30, 0)
+            slice_end = min(fidx + 30, len(score_array))
+            score_slice = score_array[slice_start:slice_end]
+            avg_score = float(np.mean(score_slice)
+                              if len(score_slice) > 0 else 0)
+            faces[frame].append(
+                {'track': tidx, 'score': avg_score, 's': track['proc_track']["s"][fidx], 'x': track['proc_track']["x"][fidx], 'y': track['proc_track']["y"][fidx]})
+
+    speaker_x = np.full(num_frames, np.nan)
+    for fidx, current_faces in enumerate(faces):
+        max_score_face = max(
+            current_faces, key=lambda face: face['score']) if current_faces else None
+        if max_score_face and max_score_face['score'] >= 0:
+            speaker_x[fidx] = max_score_face["x"]
+    return speaker_x
+
+
+def bench_speaker_selection(args):
+    if args.tracks and args.scores:
+        with open(args.tracks, "rb") as f:
+            tracks = pickle.load(f)
+        with open(args.scores, "rb") as f:
+            scores = pickle.load(f)
+    else:
+        tracks, scores = synthetic_tracks(args.frames, args.num_tracks, args.seed)
+        if args.write_pickles:
+            with open(f"{args.write_pickles}/tracks.pckl", "wb") as f:
+                pickle.dump(tracks, f)
+            with open(f"{args.write_pickles}/scores.pckl", "wb") as f:
+                pickle.dump(scores, f)
+
+    num_frames = max(int(track["track"]["frame"][-1]) for track in tracks) + 1
+    legacy_time, legacy_x = _time_call(
+        lambda: legacy_speaker_selection(tracks, scores, num_frames), args.repeat)
+    vector_time, vector_x = _time_call(
+        lambda: select_speaker_per_frame(tracks, scores, num_frames), args.repeat)
+
+    same_mode = np.isnan(legacy_x) == np.isnan(vector_x)
+    same_crop = same_mode & (np.isnan(legacy_x) | (np.nan_to_num(legacy_x) == np.nan_to_num(vector_x)))
+    print(f"frames={num_frames} tracks={len(tracks)}")
+    print(f"legacy loop:  {legacy_time * 1000:.2f} ms")
+    print(f"vectorized:   {vector_time * 1000:.2f} ms ({legacy_time / vector_time:.1f}x)")
+    print(f"crop decisions identical: {int(same_crop.sum())}/{num_frames}")
+
+
+def legacy_resize_frame(img, target_width=1080, target_height=1920):
+    """create_vertical_video's resize-mode body before ResizeFrameRenderer."""
+    scale = target_width / img.shape[1]
+    resized_height = int(img.shape[0] * scale)
+    resized_image = cv2.resize(
+        img, (target_width, resized_height), interpolation=cv2.INTER_AREA)
+
+    scale_for_bg = max(
+        target_width / img.shape[1], target_height / img.shape[0])
+    bg_width = int(img.shape[1] * scale_for_bg)
+    bg_heigth = int(img.shape[0] * scale_for_bg)
+
+    blurred_background = cv2.resize(img, (bg_width, bg_heigth))
+    blurred_background = cv2.GaussianBlur(
+        blurred_background, (121, 121), 0)
+
+    crop_x = (bg_width - target_width) // 2
+    crop_y = (bg_heigth - target_height) // 2
+    blurred_background = blurred_background[crop_y:crop_y +
+                                            target_height, crop_x:crop_x + target_width]
+
+    center_y = (target_height - resized_height) // 2
+    blurred_background[center_y:center_y +
+                       resized_height, :] = resized_image
+    return blurred_background
+
+
+def _psnr(reference, candidate):
+    mse = np.mean((reference.astype(np.float64) - candidate.astype(np.float64)) ** 2)
+    return float("inf") if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+
+
+def bench_background(args):
+    rng = np.random.default_rng(args.seed)
+    # Smooth gradients plus noise look more like video than pure noise does
+    base = cv2.resize(rng.integers(0, 256, (9, 16, 3), dtype=np.uint8), (args.width, args.height),
+                      interpolation=cv2.INTER_CUBIC)
+    frames = [cv2.add(base, rng.integers(0, 24, base.shape, dtype=np.uint8)) for _ in range(args.frames)]
+
+    def run_legacy():
+        return [legacy_resize_frame(frame).copy() for frame in frames]
+
+    legacy_time, legacy_out = _time_call(run_legacy, args.repeat)
+    print(f"source {args.width}x{args.height}, {args.frames} frames")
+    print(f"legacy:            {legacy_time / args.frames * 1000:.2f} ms/frame")
+
+    for blur_scale in args.scales:
+        renderer = ResizeFrameRenderer(args.width, args.height, blur_scale=blur_scale)
+
+        def run_engine():
+            return [renderer.render(frame).copy() for frame in frames]
+
+        engine_time, engine_out = _time_call(run_engine, args.repeat)
+        psnr = min(_psnr(ref, out) for ref, out in zip(legacy_out, engine_out))
+        print(f"blur_scale={blur_scale:<5} {engine_time / args.frames * 1000:.2f} ms/frame "
+              f"({legacy_time / engine_time:.1f}x), min PSNR vs legacy {psnr:.1f} dB")
+
+
+def bench_cut_seek(args):
+    duration = probe_video(args.video)["duration"]
+    index_start = time.perf_counter()
+    keyframe_index = KeyframeIndex(args.video)
+    print(f"keyframe index: {len(keyframe_index.times)} keyframes in {time.perf_counter() - index_start:.2f} s")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_path = os.path.join(tmp_dir, "cut.mp4")
+        print(f"{'offset':>8} {'output-seek':>12} {'input-seek':>11} {'copy':>8}")
+        for fraction in args.offsets:
+            start = max(0.0, min(duration - args.clip_length, duration * fraction))
+            end = start + args.clip_length
+
+            legacy_start = time.perf_counter()
+            subprocess.run(f"ffmpeg -y -i {args.video} -ss {start} -t {args.clip_length} {output_path}",
+                           shell=True, check=True, capture_output=True)
+            legacy_time = time.perf_counter() - legacy_start
+
+            seek_start = time.perf_counter()
+            cut_segment(args.video, start, end, output_path)
+            seek_time = time.perf_counter() - seek_start
+
+            keyframe = keyframe_index.keyframe_at_or_before(start) or 0.0
+            copy_start = time.perf_counter()
+            cut_segment(args.video, keyframe, keyframe + args.clip_length, output_path,
+                        keyframe_index=keyframe_index)
+            copy_time = time.perf_counter() - copy_start
+
+            print(f"{start:>7.0f}s {legacy_time:>11.2f}s {seek_time:>10.2f}s {copy_time:>7.2f}s")
+
+
+def _count_new_connections():
+    """Patch urllib3 so every new TCP connection bumps the returned counter."""
+    from urllib3.connectionpool import HTTPConnectionPool
+
+    counter = {"new": 0}
+    original = HTTPConnectionPool._new_conn
+
+    def counting_new_conn(pool):
+        counter["new"] += 1
+        return original(pool)
+
+    HTTPConnectionPool._new_conn = counting_new_conn
+    return counter
+
+
+def bench_s3_upload(args):
+    if args.endpoint_url:
+        os.environ["S3_ENDPOINT_URL"] = args.endpoint_url
+        import main as pipeline
+        pipeline.s3_endpoint_url = args.endpoint_url
+
+    counter = _count_new_connections()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = []
+        for index in range(args.files):
+            path = os.path.join(tmp_dir, f"clip_{index}.mp4")
+            with open(path, "wb") as f:
+                f.write(os.urandom(args.size_mb * 1024 * 1024))
+            paths.append(path)
+
+        counter["new"] = 0
+        start = time.perf_counter()
+        for index, path in enumerate(paths):
+            make_s3_client().upload_file(path, args.bucket, f"bench/legacy/clip_{index}.mp4")
+        legacy_time = time.perf_counter() - start
+        legacy_conns = counter["new"]
+
+        manager = S3TransferManager()
+        counter["new"] = 0
+        start = time.perf_counter()
+        futures = [manager.submit(manager.upload, path, args.bucket, f"bench/pooled/clip_{index}.mp4")
+                   for index, path in enumerate(paths)]
+        results = [future.result() for future in futures]
+        pooled_time = time.perf_counter() - start
+        pooled_conns = counter["new"]
+
+        start = time.perf_counter()
+        rerun = [manager.upload(path, args.bucket, f"bench/pooled/clip_{index}.mp4")
+                 for index, path in enumerate(paths)]
+        rerun_time = time.perf_counter() - start
+
+    print(f"{args.files} files x {args.size_mb} MB")
+    print(f"client per upload: {legacy_time:.2f} s, {legacy_conns} new connections")
+    print(f"pooled manager:    {pooled_time:.2f} s, {pooled_conns} new connections ({results.count('uploaded')} uploaded)")
+    print(f"re-upload:         {rerun_time:.2f} s ({rerun.count('skipped')} skipped as identical)")
+
+
+class FakeLLM:
+    """generate_content(prompt).text stand-in that sleeps like a remote model.
+
+    Picks one 45 s clip per 5 minutes of the words embedded in the prompt and
+    fails the first call for every fail_every-th prompt to exercise retries.
+    """
+
+    def __init__(self, latency, fail_every=0, seed=0):
+        self.latency = latency
+        self.fail_every = fail_every
+        self.rng = np.random.default_rng(seed)
+        self.calls = 0
+        self.failed = set()
+
+    def generate_content(self, prompt):
+        self.calls += 1
+        time.sleep(self.latency * self.rng.uniform(0.8, 1.2))
+        starts = [float(value) for value in re.findall(r"^([0-9.]+)\|", prompt, flags=re.MULTILINE)]
+        if self.fail_every and len(starts) % self.fail_every == 0 and prompt not in self.failed:
+            self.failed.add(prompt)
+            from google.api_core import exceptions as google_exceptions
+            raise google_exceptions.TooManyRequests("Resource exhausted")
+        clips = []
+        if starts:
+            for start in np.arange(starts[0], starts[-1] - 45, 300):
+                clips.append({"start": round(float(start), 2), "end": round(float(start) + 45, 2)})
+        return types.SimpleNamespace(text="```json\n" + json.dumps(clips) + "\n```")
+
+
+def bench_gemini_fanout(args):
+    # main1 pulls in the whole Modal image's dependencies, so only import it here
+    import main1
+
+    words = [{"word": "word", "start": round(i * 0.4, 2), "end": round(i * 0.4 + 0.3, 2)}
+             for i in range(int(args.minutes * 60 / 0.4))]
+
+    def run_sequential():
+        clips = []
+        llm = FakeLLM(args.latency, seed=args.seed)
+        for chunk in main1.chunk_transcript_words(words, chunk_duration=600):
+            clips.extend(main1.parse_clip_list(llm.generate_content(main1.viral_clips_prompt(chunk)).text))
+        return clips
+
+    def run_parallel():
+        return main1.select_viral_clips_with_gemini(words, FakeLLM(args.latency, args.fail_every, args.seed),
+                                                    max_workers=args.workers,
+                                                    requests_per_minute=args.requests_per_minute)
+
+    sequential_time, sequential_clips = _time_call(run_sequential, 1)
+    parallel_time, parallel_clips = _time_call(run_parallel, 1)
+    overlaps = sum(1 for a, b in zip(parallel_clips, parallel_clips[1:]) if b["start"] < a["end"])
+    print(f"{args.minutes:.0f} min transcript, {args.latency:.1f} s simulated latency")
+    print(f"sequential: {sequential_time:.2f} s, {len(sequential_clips)} clips")
+    print(f"parallel:   {parallel_time:.2f} s, {len(parallel_clips)} clips, {overlaps} overlapping "
+          f"({sequential_time / parallel_time:.1f}x)")
+
+
+def synthetic_transcript(minutes, seed=0):
+    """Word dicts shaped like transcribe_video's output, with punctuated sentences."""
+    rng = np.random.default_rng(seed)
+    vocabulary = ["the", "podcast", "really", "think", "because", "that's", "startup", "money", "people",
+                  "actually", "interesting", "question", "you", "know", "we", "built", "it", "and", "so"]
+    words, now = [], 0.0
+    while now < minutes * 60:
+        for position in range(int(rng.integers(6, 20))):
+            duration = float(rng.uniform(0.15, 0.5))
+            word = str(rng.choice(vocabulary))
+            words.append({"start": round(now, 3), "end": round(now + duration, 3), "word": word})
+            now += duration + float(rng.uniform(0.02, 0.12))
+        words[-1]["word"] += str(rng.choice([".", ".", "?", "!"]))
+        now += float(rng.uniform(0.2, 1.2))
+    return words
+
+
+def _token_counter():
+    try:
+        import tiktoken
+    except ImportError:
+        # Roughly 4 bytes per token for English text
+        return "bytes/4 estimate", lambda text: len(text.encode()) // 4
+    encoding = tiktoken.get_encoding("cl100k_base")
+    return "tiktoken cl100k_base", lambda text: len(encoding.encode(text))
+
+
+def bench_prompt_size(args):
+    if args.transcript:
+        with open(args.transcript) as f:
+            samples = {os.path.basename(args.transcript): json.load(f)}
+    else:
+        samples = {f"synthetic {minutes:g} min": synthetic_transcript(minutes, args.seed) for minutes in args.minutes}
+
+    counter_name, count_tokens = _token_counter()
+    print(f"tokens: {counter_name}")
+    print(f"{'transcript':<22} {'words':>7} {'repr bytes':>11} {'compact bytes':>14} {'repr tokens':>12} "
+          f"{'compact tokens':>15} {'ratio':>6}")
+    for name, words in samples.items():
+        legacy, compact = str(words), serialize_transcript(Transcript.from_segments(words))
+        legacy_tokens, compact_tokens = count_tokens(legacy), count_tokens(compact)
+        print(f"{name:<22} {len(words):>7} {len(legacy.encode()):>11} {len(compact.encode()):>14} "
+              f"{legacy_tokens:>12} {compact_tokens:>15} {legacy_tokens / max(compact_tokens, 1):>5.1f}x")
+
+        # Every line boundary must snap back to the exact word timestamps
+        lines = [line.split("|") for line in compact.splitlines()[1:]]
+        moments = [{"start": float(line[0]), "end": float(line[1])} for line in lines]
+        snapped = snap_moments_to_words(moments, Transcript.from_segments(words))
+        exact = sum(1 for moment in snapped if any(moment["start"] == word["start"] for word in words))
+        print(f"{'':<22} boundaries snapped to word starts: {exact}/{len(snapped)}")
+
+
+def synthetic_speech_wav(words, wav_path, sample_rate=16000, seed=0):
+    """16-bit mono WAV that is loud during words and near-silent between them."""
+    rng = np.random.default_rng(seed)
+    samples = rng.normal(0, 60, int((words[-1]["end"] + 1) * sample_rate))
+    for word in words:
+        first, last = int(word["start"] * sample_rate), int(word["end"] * sample_rate)
+        samples[first:last] += rng.normal(0, 4000, last - first)
+    with wave.open(wav_path, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(np.clip(samples, -32768, 32767).astype("<i2").tobytes())
+
+
+def bench_moments(args):
+    engine = HeuristicMomentEngine()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for minutes in args.minutes:
+            words = synthetic_transcript(minutes, args.seed)
+            wav_path = os.path.join(tmp_dir, "audio.wav")
+            synthetic_speech_wav(words, wav_path, seed=args.seed)
+            source_audio = SourceAudio(wav_path)
+            transcript = Transcript.from_segments(words)
+
+            text_time, text_moments = _time_call(lambda: engine.select(transcript), args.repeat)
+            audio_time, audio_moments = _time_call(lambda: engine.select(transcript, source_audio), args.repeat)
+            lengths = [moment["end"] - moment["start"] for moment in audio_moments]
+            print(f"{minutes:>5g} min: {len(words)} words, words only {text_time * 1000:.1f} ms, "
+                  f"with audio {audio_time * 1000:.1f} ms, {len(audio_moments)} moments "
+                  f"({min(lengths, default=0):.1f}-{max(lengths, default=0):.1f} s)")
+
+
+def bench_vad(args):
+    words = synthetic_transcript(args.minutes, args.seed)
+    # Insert long silent stretches (intro, breaks) the VAD should skip
+    rng = np.random.default_rng(args.seed)
+    shift = 0.0
+    for index, word in enumerate(words):
+        if index and index % args.silence_every == 0:
+            shift += float(rng.uniform(5, 30))
+        word["start"] += shift
+        word["end"] += shift
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        wav_path = os.path.join(tmp_dir, "audio.wav")
+        synthetic_speech_wav(words, wav_path, seed=args.seed)
+        source_audio = SourceAudio(wav_path)
+
+        def plan():
+            energy_db = frame_energy_db(source_audio)
+            return plan_transcription_chunks(energy_db, speech_regions(energy_db), max_chunk_s=args.chunk_s)
+
+        plan_time, chunks = _time_call(plan, args.repeat)
+        covered = sum(1 for word in words
+                      if any(start <= word["start"] and word["end"] <= end for start, end in chunks))
+        decoded = sum(end - start for start, end in chunks)
+        print(f"{source_audio.duration / 60:.1f} min audio, VAD + chunk plan in {plan_time * 1000:.0f} ms")
+        print(f"{len(chunks)} chunks (longest {max(end - start for start, end in chunks):.0f}s), "
+              f"decoding {decoded:.0f}s ({decoded / source_audio.duration:.0%} of the audio)")
+        print(f"words fully inside a chunk: {covered}/{len(words)}")
+
+
+def bench_transcript(args):
+    words = synthetic_transcript(args.minutes, args.seed)
+    transcript = Transcript.from_segments(words)
+    rng = np.random.default_rng(args.seed)
+    ranges = [(start, start + 45.0) for start in rng.uniform(0, words[-1]["end"] - 45.0, args.queries)]
+
+    def legacy_filter():
+        return [[segment for segment in words
+                 if segment.get("start") is not None and segment.get("end") is not None
+                 and segment.get("end") > start and segment.get("start") < end] for start, end in ranges]
+
+    def indexed_filter():
+        return [transcript.words_between(start, end) for start, end in ranges]
+
+    legacy_time, legacy_out = _time_call(legacy_filter, args.repeat)
+    indexed_time, indexed_out = _time_call(indexed_filter, args.repeat)
+    same = all(len(a) == len(b) for a, b in zip(legacy_out, indexed_out))
+    print(f"{len(words)} words, {args.queries} clip-range queries")
+    print(f"list scan:     {legacy_time / args.queries * 1e6:.1f} us/query")
+    print(f"words_between: {indexed_time / args.queries * 1e6:.1f} us/query "
+          f"({legacy_time / indexed_time:.0f}x), same words: {same}")
+
+    json_time, json_bytes = _time_call(lambda: json.dumps(words).encode(), args.repeat)
+    npz_time, npz_bytes = _time_call(transcript.to_bytes, args.repeat)
+    json_load, _ = _time_call(lambda: json.loads(json_bytes), args.repeat)
+    npz_load, _ = _time_call(lambda: Transcript.from_bytes(npz_bytes), args.repeat)
+    print(f"json: {len(json_bytes) / 1024:.0f} KiB, dump {json_time * 1000:.1f} ms, load {json_load * 1000:.1f} ms")
+    print(f"npz:  {len(npz_bytes) / 1024:.0f} KiB, dump {npz_time * 1000:.1f} ms, load {npz_load * 1000:.1f} ms")
+
+
+def legacy_subtitle_document(words, clip_start, clip_end, max_words=5):
+    """Per-clip subtitle writing before SubtitleEngine: a list scan and a fresh SSAFile per clip."""
+    clip_segments = [segment for segment in words
+                     if segment.get("start") is not None and segment.get("end") is not None
+                     and segment.get("end") > clip_start and segment.get("start") < clip_end]
+    subtitles, current_words = [], []
+    for segment in clip_segments:
+        word = segment.get("word", "").strip()
+        start_rel, end_rel = max(0.0, segment["start"] - clip_start), max(0.0, segment["end"] - clip_start)
+        if not word or end_rel <= 0:
+            continue
+        if current_words and len(current_words) < max_words:
+            current_words.append(word)
+            current_end = end_rel
+            continue
+        if current_words:
+            subtitles.append((current_start, current_end, " ".join(current_words)))
+        current_words, current_start, current_end = [word], start_rel, end_rel
+    if current_words:
+        subtitles.append((current_start, current_end, " ".join(current_words)))
+
+    subs = pysubs2.SSAFile()
+    subs.info.update({"WrapStyle": 0, "ScaledBorderAndShadow": "yes", "PlayResX": 1080, "PlayResY": 1920,
+                      "ScriptType": "v4.00+"})
+    style = pysubs2.SSAStyle()
+    style.fontname, style.fontsize = "Anton", 140
+    style.primarycolor = pysubs2.Color(255, 255, 255)
+    style.outline, style.shadow = 2.0, 2.0
+    style.shadowcolor = pysubs2.Color(0, 0, 0, 128)
+    style.alignment, style.marginl, style.marginr, style.marginv, style.spacing = 2, 50, 50, 50, 0.0
+    subs.styles["Default"] = style
+    for start, end, text in subtitles:
+        subs.events.append(pysubs2.SSAEvent(start=pysubs2.make_time(s=start), end=pysubs2.make_time(s=end),
+                                            text=text, style="Default"))
+    return subs.to_string("ass")
+
+
+def bench_subtitles(args):
+    words = synthetic_transcript(args.minutes, args.seed)
+    transcript = Transcript.from_segments(words)
+    rng = np.random.default_rng(args.seed)
+    moments = [{"start": float(start), "end": float(start) + 45.0}
+               for start in np.sort(rng.uniform(0, words[-1]["end"] - 45.0, args.clips))]
+
+    legacy_time, legacy_docs = _time_call(
+        lambda: [legacy_subtitle_document(words, moment["start"], moment["end"]) for moment in moments], args.repeat)
+    engine_time, engine_docs = _time_call(lambda: subtitle_engine.render_many(transcript, moments), args.repeat)
+    identical = sum(1 for a, b in zip(legacy_docs, engine_docs) if a == b)
+    print(f"{len(words)} words, {len(moments)} clips")
+    print(f"per-clip pysubs2:   {legacy_time / len(moments) * 1000:.2f} ms/clip")
+    print(f"SubtitleEngine:     {engine_time / len(moments) * 1000:.2f} ms/clip ({legacy_time / engine_time:.0f}x)")
+    print(f"identical documents: {identical}/{len(moments)}")
+
+
+def bench_encoders(args):
+    import main as pipeline
+
+    rng = np.random.default_rng(args.seed)
+    base = cv2.resize(rng.integers(0, 256, (16, 9, 3), dtype=np.uint8), (1080, 1920), interpolation=cv2.INTER_CUBIC)
+    frames = [np.roll(base, shift * 4, axis=1) for shift in range(args.frames)]
+
+    probe = pipeline.VideoEncoder()
+    listed = probe.listed_encoders()
+    print(f"{'encoder':<8} {'profile':<13} {'fps':>7} {'KiB':>7}")
+    for name in pipeline.VideoEncoder.candidates:
+        if pipeline.VideoEncoder.codecs[name] not in listed or not probe.test_encode(name):
+            print(f"{name:<8} unavailable")
+            continue
+        encoder = pipeline.VideoEncoder(preference=name)
+        for profile in ("final", "intermediate"):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                output_path = os.path.join(tmp_dir, "out.mp4")
+
+                def encode():
+                    writer = pipeline.FfmpegPipeWriter(output_path, 1080, 1920, 25, encoder, profile=profile)
+                    for frame in frames:
+                        writer.write(frame)
+                    writer.release()
+
+                encode_time, _ = _time_call(encode, args.repeat)
+                print(f"{name:<8} {profile:<13} {args.frames / encode_time:>7.1f} "
+                      f"{os.path.getsize(output_path) / 1024:>7.0f}")
+
+
+def bench_asd_proxy(args):
+    import main as pipeline
+
+    engine = pipeline.ActiveSpeakerEngine(proxy_height=0)
+    info = probe_video(args.video)
+    num_frames = round(info["duration"] * 25) or (info["nb_frames"] or 0)
+    print(f"source {info['width']}x{info['height']}, {num_frames} frames")
+    print(f"{'proxy':>6} {'asd_s':>7} {'tracks':>6} {'same_mode':>9} {'crop_agree':>10} {'mean_dx':>8}")
+
+    reference_x = None
+    agreeing = []
+    for height in [0] + [height for height in args.heights if height]:
+        engine.proxy_height = height
+        with tempfile.TemporaryDirectory() as work_dir:
+            start = time.perf_counter()
+            tracks, scores = engine.run(args.video, work_dir)
+            asd_time = time.perf_counter() - start
+
+        speaker_x = select_speaker_per_frame(tracks, scores, num_frames)
+        if reference_x is None:
+            reference_x = speaker_x
+        both_crop = ~np.isnan(reference_x) & ~np.isnan(speaker_x)
+        same_mode = np.isnan(reference_x) == np.isnan(speaker_x)
+        dx = np.abs(reference_x[both_crop] - speaker_x[both_crop])
+        # A crop agrees if both pick crop mode with centres within the tolerance, or both resize
+        agree = same_mode & (np.isnan(reference_x) | (np.abs(np.nan_to_num(reference_x) - np.nan_to_num(speaker_x))
+                                                      <= args.tolerance_px))
+        label = "source" if not height else str(height)
+        print(f"{label:>6} {asd_time:>7.2f} {len(tracks):>6} {same_mode.mean():>9.1%} {agree.mean():>10.1%} "
+              f"{dx.mean() if len(dx) else 0.0:>8.1f}")
+        if height and agree.mean() >= args.min_agree:
+            agreeing.append(height)
+
+    if agreeing:
+        print(f"lowest height with crop_agree >= {args.min_agree:.0%}: ASD_PROXY_HEIGHT={min(agreeing)}")
+    else:
+        print(f"no proxy height reaches crop_agree >= {args.min_agree:.0%}: keep ASD_PROXY_HEIGHT=0")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the clip pipeline.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    speaker = subparsers.add_parser("speaker-selection", help="Per-frame speaker selection in create_vertical_video")
+    speaker.add_argument("--frames", type=int, default=1500)
+    speaker.add_argument("--num_tracks", type=int, default=4)
+    speaker.add_argument("--seed", type=int, default=0)
+    speaker.add_argument("--repeat", type=int, default=5)
+    speaker.add_argument("--tracks", type=str, help="Existing tracks.pckl to benchmark instead of synthetic data")
+    speaker.add_argument("--scores", type=str, help="Existing scores.pckl matching --tracks")
+    speaker.add_argument("--write_pickles", type=str, help="Directory to save the synthetic tracks/scores pickles to")
+    speaker.set_defaults(func=bench_speaker_selection)
+
+    background = subparsers.add_parser("background", help="Resize-mode blurred background rendering")
+    background.add_argument("--width", type=int, default=1920)
+    background.add_argument("--height", type=int, default=1080)
+    background.add_argument("--frames", type=int, default=50)
+    background.add_argument("--seed", type=int, default=0)
+    background.add_argument("--repeat", type=int, default=3)
+    background.add_argument("--scales", type=float, nargs="+", default=[1.0, 0.5, 0.25, 0.125])
+    background.set_defaults(func=bench_background)
+
+    cut = subparsers.add_parser("cut-seek", help="Clip cut time vs start offset (output seek, input seek, stream copy)")
+    cut.add_argument("--video", type=str, required=True)
+    cut.add_argument("--clip_length", type=float, default=45.0)
+    cut.add_argument("--offsets", type=float, nargs="+", default=[0.0, 0.25, 0.5, 0.75, 0.95],
+                     help="Clip start as a fraction of the source duration")
+    cut.set_defaults(func=bench_cut_seek)
+
+    s3 = subparsers.add_parser("s3-upload", help="Per-clip boto3 clients vs the pooled S3TransferManager")
+    s3.add_argument("--bucket", type=str, required=True)
+    s3.add_argument("--endpoint_url", type=str, help="S3-compatible endpoint, e.g. a local MinIO or moto server")
+    s3.add_argument("--files", type=int, default=5)
+    s3.add_argument("--size_mb", type=int, default=24)
+    s3.set_defaults(func=bench_s3_upload)
+
+    fanout = subparsers.add_parser("gemini-fanout", help="Sequential vs parallel chunked moment selection in main1.py")
+    fanout.add_argument("--minutes", type=float, default=180)
+    fanout.add_argument("--latency", type=float, default=2.0, help="Simulated seconds per LLM call")
+    fanout.add_argument("--workers", type=int, default=6)
+    fanout.add_argument("--requests_per_minute", type=int, default=120)
+    fanout.add_argument("--fail_every", type=int, default=0, help="Fail the first call for some chunks to exercise retries")
+    fanout.add_argument("--seed", type=int, default=0)
+    fanout.set_defaults(func=bench_gemini_fanout)
+
+    prompt = subparsers.add_parser("prompt-size", help="Prompt bytes/tokens for str(transcript) vs serialize_transcript")
+    prompt.add_argument("--transcript", type=str, help="JSON word list from transcribe_video instead of synthetic data")
+    prompt.add_argument("--minutes", type=float, nargs="+", default=[10, 60, 180])
+    prompt.add_argument("--seed", type=int, default=0)
+    prompt.set_defaults(func=bench_prompt_size)
+
+    moments = subparsers.add_parser("moments", help="HeuristicMomentEngine latency on synthetic transcripts")
+    moments.add_argument("--minutes", type=float, nargs="+", default=[10, 60, 180])
+    moments.add_argument("--seed", type=int, default=0)
+    moments.add_argument("--repeat", type=int, default=3)
+    moments.set_defaults(func=bench_moments)
+
+    vad = subparsers.add_parser("vad", help="Energy VAD and transcription chunk planning on synthetic speech")
+    vad.add_argument("--minutes", type=float, default=60)
+    vad.add_argument("--chunk_s", type=float, default=240)
+    vad.add_argument("--silence_every", type=int, default=800, help="Insert a 5-30 s silence every N words")
+    vad.add_argument("--seed", type=int, default=0)
+    vad.add_argument("--repeat", type=int, default=3)
+    vad.set_defaults(func=bench_vad)
+
+    transcript = subparsers.add_parser("transcript", help="Transcript range queries and cache format vs lists of dicts")
+    transcript.add_argument("--minutes", type=float, default=180)
+    transcript.add_argument("--queries", type=int, default=200)
+    transcript.add_argument("--seed", type=int, default=0)
+    transcript.add_argument("--repeat", type=int, default=3)
+    transcript.set_defaults(func=bench_transcript)
+
+    subtitles = subparsers.add_parser("subtitles", help="Per-clip pysubs2 documents vs SubtitleEngine.render_many")
+    subtitles.add_argument("--minutes", type=float, default=180)
+    subtitles.add_argument("--clips", type=int, default=20)
+    subtitles.add_argument("--seed", type=int, default=0)
+    subtitles.add_argument("--repeat", type=int, default=3)
+    subtitles.set_defaults(func=bench_subtitles)
+
+    encoders = subparsers.add_parser("encoders", help="Encode speed and size for each H.264 encoder that works here")
+    encoders.add_argument("--frames", type=int, default=100)
+    encoders.add_argument("--seed", type=int, default=0)
+    encoders.add_argument("--repeat", type=int, default=1)
+    encoders.set_defaults(func=bench_encoders)
+
+    asd_proxy = subparsers.add_parser("asd-proxy", help="In-process ASD time and crop agreement at proxy resolutions (GPU)")
+    asd_proxy.add_argument("--video", type=str, required=True, help="A clip, e.g. a cut from a 4K upload")
+    asd_proxy.add_argument("--heights", type=int, nargs="+", default=[1080, 720, 540, 360])
+    asd_proxy.add_argument("--tolerance_px", type=float, default=32.0,
+                           help="Max crop-centre difference, in source pixels, that counts as agreement")
+    asd_proxy.add_argument("--min_agree", type=float, default=0.98,
+                           help="crop_agree a proxy height needs to be recommended")
+    asd_proxy.set_defaults(func=bench_asd_proxy)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
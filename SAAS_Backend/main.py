@@ -1,16 +1,30 @@
+import concurrent.futures
+import contextlib
+import copy
 import glob
+import hashlib
 import json
 import pathlib
 import pickle
+import resource
 import shutil
 import subprocess
+import sys
+import tempfile
+import threading
 import time
+import urllib.request
 import uuid
+import wave
+from bisect import bisect_right
+from collections import OrderedDict
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import BotoCoreError, ClientError
 import cv2
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-import ffmpegcv
 import modal
 import numpy as np
 from pydantic import BaseModel
@@ -21,10 +35,26 @@ import pysubs2
 from tqdm import tqdm
 import whisperx
 
+from transcript import Transcript, sentence_spans, serialize_transcript, snap_moments_to_words
+from video_encoding import FfmpegPipeWriter, VideoEncoder
 
 
 class ProcessVideoRequest(BaseModel):
     s3_key: str
+    max_concurrent_clips: int | None = None
+    include_timings: bool = False
+
+
+class SubmitJobRequest(ProcessVideoRequest):
+    webhook_url: str | None = None
+
+
+class SubmitBatchRequest(BaseModel):
+    # Either an explicit list, or a manifest object in the input bucket
+    s3_keys: list[str] | None = None
+    manifest_s3_key: str | None = None
+    max_concurrent_clips: int | None = None
+    webhook_url: str | None = None
 
 image = (modal.Image.from_registry(
     "nvidia/cuda:12.4.0-devel-ubuntu22.04",add_python="3.12")
@@ -34,7 +64,8 @@ image = (modal.Image.from_registry(
                    "wget -O /usr/share/fonts/truetype/custom/Anton-Regular.ttf https://github.com/google/fonts/raw/main/ofl/anton/Anton-Regular.ttf",
                    "fc-cache -f -v"])
                    
-    .add_local_dir("asd", "/asd",copy=True))
+    .add_local_dir("asd", "/asd",copy=True)
+    .add_local_python_source("transcript", "video_encoding"))
 
 app= modal.App("clipgenius-ai", image=image)
 
@@ -44,83 +75,549 @@ volume= modal.Volume.from_name(
 
 mount_path= "/root/.cache/torch"
 
+# Per-clip handoff between the GPU stages and the CPU render workers
+artifacts_volume = modal.Volume.from_name("clipgenius-artifacts", create_if_missing=True)
+artifacts_mount = "/artifacts"
+artifacts_dir = pathlib.Path(os.environ.get("ARTIFACTS_DIR", artifacts_mount))
+
+input_bucket = os.environ.get("INPUT_BUCKET", "ai-podcast-clipper200")
+output_bucket = os.environ.get("OUTPUT_BUCKET", "ai-podcast-clipper")
+# Point boto3 at a local S3 stand-in (moto server, MinIO) for testing
+s3_endpoint_url = os.environ.get("S3_ENDPOINT_URL") or None
+s3_max_pool_connections = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", "32"))
+s3_multipart_chunk_size = int(os.environ.get("S3_MULTIPART_CHUNK_SIZE", str(8 * 1024 * 1024)))
+s3_max_concurrency = int(os.environ.get("S3_MAX_CONCURRENCY", "10"))
+# Background upload workers; uploads overlap with rendering the next clip
+s3_upload_workers = int(os.environ.get("S3_UPLOAD_WORKERS", "2"))
+
+# Job records for the async API, shared by every container
+jobs = modal.Dict.from_name("clipgenius-jobs", create_if_missing=True)
+# Per-container cache counters, published so a CPU endpoint can report them all
+cache_stats_store = modal.Dict.from_name("clipgenius-cache-stats", create_if_missing=True)
+container_id = os.environ.get("MODAL_TASK_ID") or uuid.uuid4().hex
+# Wall-clock limit of one pipeline call (run_job, run_batch, process_video)
+pipeline_timeout_s = 900
+# A queued/running job with no progress for this long is treated as lost; a
+# running call can't outlive its timeout, so a little past it is enough.
+job_stale_after_s = pipeline_timeout_s + 60
+# A batch stops taking new videos after this long and hands the rest to a fresh
+# run_batch call, so in-flight videos still finish inside the 900 s timeout.
+batch_time_budget_s = float(os.environ.get("BATCH_TIME_BUDGET_S", "540"))
+
 auth_scheme =HTTPBearer()
 
-def create_vertical_video(tracks, scores, pyframes_path, pyavi_path, audio_path, output_path, framerate=25):
-    target_width = 1080
-    target_height = 1920
+max_clips_per_video = 5
+# Clips are independent (own segment, ASD run, render and upload), so they are
+# fanned out over a bounded pool. Override per request with max_concurrent_clips.
+default_clip_concurrency = int(os.environ.get("CLIP_CONCURRENCY", "3"))
+# "stream" decodes render frames straight from the ASD video; "pyframes" reads
+# the JPEGs Columbia_test.py extracted (previous behaviour).
+frame_source = os.environ.get("FRAME_SOURCE", "stream")
+# Resolution factor the resize-mode background is blurred at (1.0 = full-size
+# blur as before; smaller is faster and visually the same under a 121px blur).
+background_blur_scale = float(os.environ.get("BACKGROUND_BLUR_SCALE", "0.25"))
+# "single_pass" pipes rendered frames into one ffmpeg encode that also muxes the
+# audio and burns the subtitles; "multi_pass" keeps the render/mux/burn chain.
+render_mode = os.environ.get("RENDER_MODE", "single_pass")
+# off: every stage runs in the GPU container. modal: cut/ASD stay on the GPU,
+# render/burn/upload run on ClipRenderer CPU workers, and clip artifacts go
+# through the artifacts volume. local: the same handoff, all in this process.
+# In modal mode run_job returns once ASD is done and the workers finish the job
+# (RenderHandoff); process_video answers with the output keys and run_batch
+# writes a manifest of every clip, so those two still wait for the renders.
+stage_split = os.environ.get("STAGE_SPLIT", "off")
+render_worker_cpu = float(os.environ.get("RENDER_WORKER_CPU", "4"))
+render_worker_memory_mb = int(os.environ.get("RENDER_WORKER_MEMORY_MB", "4096"))
+render_worker_max_containers = int(os.environ.get("RENDER_WORKER_MAX_CONTAINERS", "16"))
+# "auto" stream-copies clip cuts that start on a keyframe; "off" always re-encodes.
+clip_stream_copy = os.environ.get("CLIP_STREAM_COPY", "auto")
+# "in_process" keeps the ASD models loaded in the container; "subprocess" shells
+# out to Columbia_test.py for every clip.
+asd_mode = os.environ.get("ASD_MODE", "in_process")
+asd_root = "/asd"
+asd_pretrain_model = "weight/finetuning_TalkSet.model"
+# In-process ASD runs on a copy downscaled to this height (0 = source resolution).
+# Tracks are mapped back to source pixels and the render reads the full-resolution cut.
+# Off until `bench.py asd-proxy` on representative uploads picks a height whose
+# crops agree with source-resolution ASD.
+asd_proxy_height = int(os.environ.get("ASD_PROXY_HEIGHT", "0"))
+
+whisperx_model_name = "large-v2"
+whisperx_compute_type = "float16"
+whisperx_batch_size = 16
+alignment_language = "en"
+# "full" is one WhisperX call for the file. "vad_chunked" transcribes speech
+# regions found by an energy VAD in bounded chunks (flat memory, words streamed
+# per chunk). It is opt-in: the energy gate drops quiet speech under a noisy floor
+# and lets music beds through, and is only validated on synthetic audio so far.
+transcribe_mode = os.environ.get("TRANSCRIBE_MODE", "full")
+transcribe_chunk_s = float(os.environ.get("TRANSCRIBE_CHUNK_S", "240"))
+# Word-segment JSON is cached on the model volume, keyed by the source's ETag
+# plus everything above that changes the transcript.
+transcript_cache_enabled = os.environ.get("TRANSCRIPT_CACHE", "on") == "on"
+transcript_cache_max_bytes = int(os.environ.get("TRANSCRIPT_CACHE_MAX_BYTES", str(1024 ** 3)))
+# Download the source with ranged GETs and feed audio extraction while it
+# arrives, instead of downloading first and extracting afterwards.
+streaming_ingest = os.environ.get("STREAMING_INGEST", "on") == "on"
+ingest_part_size = int(os.environ.get("INGEST_PART_SIZE", str(16 * 1024 * 1024)))
+ingest_concurrency = int(os.environ.get("INGEST_CONCURRENCY", "4"))
+# Tries per ranged GET before the download fails (dropped connections, 5xx, throttling)
+ingest_part_attempts = int(os.environ.get("INGEST_PART_ATTEMPTS", "4"))
+# "gemini" asks the LLM and falls back to the local heuristic engine when the
+# call fails, times out or returns unparseable output; "heuristic" skips the LLM.
+moment_engine = os.environ.get("MOMENT_ENGINE", "gemini")
+moment_fallback = os.environ.get("MOMENT_FALLBACK", "heuristic")
+gemini_timeout_s = float(os.environ.get("GEMINI_TIMEOUT_S", "90"))
+# Validated Gemini moments are cached per (transcript, prompt version, model),
+# in memory and on the volume, so re-renders get the same clips for free.
+# Bump moment_prompt_version whenever the identify_moments prompt changes.
+moment_prompt_version = "2"
+moment_cache_enabled = os.environ.get("MOMENT_CACHE", "on") == "on"
+moment_cache_ttl_s = float(os.environ.get("MOMENT_CACHE_TTL_S", str(30 * 24 * 3600)))
+moment_cache_max_bytes = int(os.environ.get("MOMENT_CACHE_MAX_BYTES", str(64 * 1024 ** 2)))
+moment_cache_memory_entries = int(os.environ.get("MOMENT_CACHE_MEMORY_ENTRIES", "256"))
+# One JSON-lines file of stage spans per run, written to the volume at the end.
+trace_log_dir = pathlib.Path(os.environ.get("TRACE_LOG_DIR", os.path.join(mount_path, "traces")))
+# Finished stages of each job (transcript, moments, per-clip ASD and uploads),
+# keyed by job_id_for(s3_key, etag), so a retried or preempted run resumes from them.
+checkpoints_enabled = os.environ.get("CHECKPOINTS", "on") == "on"
+checkpoint_dir = pathlib.Path(os.environ.get("CHECKPOINT_DIR", os.path.join(mount_path, "checkpoints")))
+# Checkpoints of partial or abandoned jobs are dropped after this long, oldest
+# first once the directory outgrows checkpoint_max_bytes
+checkpoint_ttl_s = float(os.environ.get("CHECKPOINT_TTL_S", str(7 * 24 * 3600)))
+checkpoint_max_bytes = int(os.environ.get("CHECKPOINT_MAX_BYTES", str(20 * 1024 ** 3)))
+
+
+def probe_video(video_path) -> dict:
+    probe_cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0",
+                 "-show_entries", "stream=width,height,nb_frames,r_frame_rate:stream_side_data=rotation:format=duration",
+                 "-of", "json", str(video_path)]
+    result = subprocess.run(probe_cmd, check=True, capture_output=True, text=True)
+    info = json.loads(result.stdout)
+    stream = info["streams"][0]
+
+    width, height = int(stream["width"]), int(stream["height"])
+    rotation = 0
+    for side_data in stream.get("side_data_list", []):
+        rotation = int(side_data.get("rotation", rotation))
+    # ffmpeg autorotates on decode, so report the geometry frames come out with
+    if abs(rotation) % 180 == 90:
+        width, height = height, width
+
+    num, _, den = stream.get("r_frame_rate", "0/1").partition("/")
+    fps = float(num) / float(den or 1) if float(den or 1) else 0.0
+    return {
+        "width": width,
+        "height": height,
+        "fps": fps,
+        "nb_frames": int(stream["nb_frames"]) if stream.get("nb_frames", "N/A").isdigit() else None,
+        "duration": float(info.get("format", {}).get("duration", 0.0)),
+    }
+
+
+def _read_exact(stream, view) -> int:
+    filled = 0
+    while filled < len(view):
+        count = stream.readinto(view[filled:])
+        if not count:
+            break
+        filled += count
+    return filled
+
+
+def read_video_frames(video_path, framerate=25):
+    """Yield BGR frames decoded once from video_path, resampled to framerate.
+
+    Frame i lines up with pyframes/%06d.jpg index i because Columbia_test.py
+    extracts its frames from the same 25 fps stream. The yielded array is
+    reused between iterations, so copy it if it must outlive the loop body.
+    """
+    info = probe_video(video_path)
+    width, height = info["width"], info["height"]
+    decode_cmd = ["ffmpeg", "-v", "error", "-i", str(video_path), "-r", str(framerate),
+                  "-f", "rawvideo", "-pix_fmt", "bgr24", "-"]
+    process = subprocess.Popen(decode_cmd, stdout=subprocess.PIPE, bufsize=width * height * 3)
+
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    view = memoryview(frame).cast("B")
+    try:
+        while _read_exact(process.stdout, view) == len(view):
+            yield frame
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+
+
+def _iter_frame_files(flist):
+    for fname in flist:
+        yield cv2.imread(fname)
 
-    flist = glob.glob(os.path.join(pyframes_path, "*.jpg"))
-    flist.sort()
 
-    faces = [[] for _ in range(len(flist))]
+video_encoder = VideoEncoder(concurrent_encodes=default_clip_concurrency)
+
+
+class KeyframeIndex:
+    """Keyframe timestamps of a source's video stream, probed once with ffprobe.
+
+    Reads packet flags only (no decoding), so it costs one demux of the file and
+    is shared by every clip cut from that source.
+    """
+
+    def __init__(self, video_path):
+        probe_cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0",
+                     "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", str(video_path)]
+        result = subprocess.run(probe_cmd, check=True, capture_output=True, text=True)
+        times = []
+        for line in result.stdout.splitlines():
+            pts_time, _, flags = line.partition(",")
+            if "K" in flags and pts_time not in ("", "N/A"):
+                times.append(float(pts_time))
+        self.times = sorted(times)
+
+    def keyframe_at_or_before(self, timestamp: float):
+        position = bisect_right(self.times, timestamp)
+        return self.times[position - 1] if position else None
+
+    def keyframe_near(self, timestamp: float, tolerance: float):
+        candidates = [self.keyframe_at_or_before(timestamp)]
+        position = bisect_right(self.times, timestamp)
+        if position < len(self.times):
+            candidates.append(self.times[position])
+        candidates = [t for t in candidates if t is not None and abs(t - timestamp) <= tolerance]
+        return min(candidates, key=lambda t: abs(t - timestamp)) if candidates else None
+
+
+# Side work that overlaps the GPU stages, e.g. the keyframe probe during transcription
+background_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="background")
+
+
+def cut_segment(video_path, start_time: float, end_time: float, output_path,
+                keyframe_index: KeyframeIndex | None = None, keyframe_tolerance: float = 0.04):
+    """Cut [start_time, end_time) out of video_path with input-side seeking.
+
+    -ss before -i makes ffmpeg seek by index instead of decoding everything up
+    to start_time; re-encoding keeps the cut frame-accurate. When the start
+    lands on a keyframe the packets are copied instead, with no encode at all.
+    Returns "copy" or "encode".
+    """
+    duration = end_time - start_time
+    keyframe = None
+    if keyframe_index is not None and clip_stream_copy == "auto":
+        keyframe = keyframe_index.keyframe_near(start_time, keyframe_tolerance)
+
+    if keyframe is not None:
+        cut_command = (f"ffmpeg -y -ss {keyframe} -i {video_path} -t {duration} "
+                       f"-c copy -avoid_negative_ts make_zero {output_path}")
+    else:
+        cut_command = (f"ffmpeg -y {' '.join(video_encoder.input_args())} -ss {start_time} -i {video_path} "
+                       f"-t {duration} {video_encoder.encode_args(profile='intermediate')} {output_path}")
+    subprocess.run(cut_command, shell=True, check=True,
+                   capture_output=True, text=True)
+    return "copy" if keyframe is not None else "encode"
+
+
+def extract_audio(video_path, audio_path, sample_rate: int = 16000):
+    extract_cmd = f"ffmpeg -y -i {video_path} -vn -acodec pcm_s16le -ar {sample_rate} -ac 1 {audio_path}"
+    subprocess.run(extract_cmd, shell=True,
+                   check=True, capture_output=True)
+    return audio_path
+
+
+class SourceAudio:
+    """The source's 16-bit mono PCM audio.wav, decoded once and memory-mapped.
+
+    Clip audio is a zero-copy slice of the mapping, so per-clip audio costs no
+    extra ffmpeg decode.
+    """
+
+    def __init__(self, wav_path):
+        self.path = pathlib.Path(wav_path)
+        data_offset, data_size = None, None
+        with open(self.path, "rb") as f:
+            riff, _, wave_id = f.read(4), f.read(4), f.read(4)
+            if riff != b"RIFF" or wave_id != b"WAVE":
+                raise ValueError(f"{self.path} is not a RIFF/WAVE file")
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                chunk_id, chunk_size = header[:4], int.from_bytes(header[4:], "little")
+                if chunk_id == b"fmt ":
+                    fmt = f.read(chunk_size)
+                    channels = int.from_bytes(fmt[2:4], "little")
+                    self.sample_rate = int.from_bytes(fmt[4:8], "little")
+                    bits_per_sample = int.from_bytes(fmt[14:16], "little")
+                    if channels != 1 or bits_per_sample != 16:
+                        raise ValueError(f"{self.path} must be 16-bit mono PCM")
+                    if chunk_size % 2:
+                        f.seek(1, os.SEEK_CUR)
+                elif chunk_id == b"data":
+                    data_offset = f.tell()
+                    data_size = chunk_size
+                    break
+                else:
+                    f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+        if data_offset is None:
+            raise ValueError(f"{self.path} has no data chunk")
+
+        # Streamed WAVs leave the size field unset; trust the file length then
+        available = self.path.stat().st_size - data_offset
+        if data_size in (0, 0xFFFFFFFF) or data_size > available:
+            data_size = available
+        self.samples = np.memmap(self.path, dtype="<i2", mode="r", offset=data_offset,
+                                 shape=(data_size // 2,))
+
+    @property
+    def duration(self) -> float:
+        return len(self.samples) / self.sample_rate
+
+    def slice(self, start: float, end: float):
+        first = min(max(int(round(start * self.sample_rate)), 0), len(self.samples))
+        last = min(max(int(round(end * self.sample_rate)), first), len(self.samples))
+        return self.samples[first:last]
+
+    def as_float32(self):
+        # Same scaling as whisperx.load_audio, without re-running ffmpeg
+        return self.samples.astype(np.float32) / 32768.0
+
+    def write_wav(self, start: float, end: float, output_path):
+        with wave.open(str(output_path), "wb") as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(self.sample_rate)
+            wav_file.writeframes(memoryview(self.slice(start, end)).cast("B"))
+        return output_path
+
+def frame_energy_db(source_audio: SourceAudio, frame_s: float = 0.03, block_frames: int = 20000):
+    """RMS level in dBFS of every frame_s window, computed a block at a time."""
+    frame = max(1, int(source_audio.sample_rate * frame_s))
+    num_frames = len(source_audio.samples) // frame
+    energy = np.empty(num_frames, dtype=np.float32)
+    for first in range(0, num_frames, block_frames):
+        last = min(first + block_frames, num_frames)
+        block = np.asarray(source_audio.samples[first * frame:last * frame], dtype=np.float32).reshape(-1, frame)
+        rms = np.sqrt(np.mean(np.square(block / 32768.0), axis=1))
+        energy[first:last] = 20 * np.log10(rms + 1e-6)
+    return energy
+
+
+def speech_regions(energy_db, frame_s: float = 0.03, margin_db: float = 12.0, floor_db: float = -50.0,
+                   min_silence_s: float = 0.8, min_speech_s: float = 0.25, pad_s: float = 0.2):
+    """(start, end) seconds of speech: frames margin_db above the noise floor,
+    with short gaps bridged, blips dropped and each region padded."""
+    if len(energy_db) == 0:
+        return []
+    threshold = max(float(np.percentile(energy_db, 10)) + margin_db, floor_db)
+    active = np.concatenate(([False], energy_db > threshold, [False]))
+    edges = np.flatnonzero(np.diff(active.astype(np.int8)))
+    regions = []
+    for start, end in zip(edges[::2] * frame_s, edges[1::2] * frame_s):
+        if regions and start - regions[-1][1] < min_silence_s:
+            regions[-1][1] = end
+        else:
+            regions.append([start, end])
+    duration = len(energy_db) * frame_s
+    return [(max(0.0, start - pad_s), min(duration, end + pad_s))
+            for start, end in regions if end - start >= min_speech_s]
+
+
+def plan_transcription_chunks(energy_db, regions: list, frame_s: float = 0.03, max_chunk_s: float = 240.0,
+                              max_gap_s: float = 3.0, split_search_s: float = 20.0):
+    """Pack speech regions into chunks of at most max_chunk_s.
+
+    A silence longer than max_gap_s always ends a chunk so it is never decoded;
+    a region too long for one chunk is split at its quietest frame near the limit.
+    """
+    if max_chunk_s <= frame_s:
+        raise ValueError(f"max_chunk_s must be longer than one {frame_s} s frame, got {max_chunk_s}")
+    chunks = []
+    for start, end in regions:
+        if chunks and start - chunks[-1][1] <= max_gap_s and end - chunks[-1][0] <= max_chunk_s:
+            chunks[-1][1] = end
+            continue
+        while end - start > max_chunk_s:
+            # Search the back of (start, start + max_chunk_s], at most half of it,
+            # so every split moves forward by at least half a chunk
+            search_s = min(split_search_s, max_chunk_s / 2)
+            search_last = min(int((start + max_chunk_s) / frame_s), len(energy_db))
+            search_first = max(int((start + max_chunk_s - search_s) / frame_s), int(start / frame_s) + 1)
+            if search_first < search_last:
+                split = (search_first + int(np.argmin(energy_db[search_first:search_last]))) * frame_s
+            else:
+                split = start + max_chunk_s
+            if split <= start:
+                split = start + max_chunk_s
+            chunks.append([start, split])
+            start = split
+        chunks.append([start, end])
+    return [(start, end) for start, end in chunks]
+
+
+def smooth_track_scores(score_array, track_length: int, window: int = 30):
+    """Mean of score_array[max(i - window, 0):min(i + window, len)] for every
+    frame i of a track, via one cumulative sum instead of a slice per frame."""
+    score_array = np.asarray(score_array, dtype=np.float64).ravel()
+    cumulative = np.concatenate(([0.0], np.cumsum(score_array)))
+
+    fidx = np.arange(track_length)
+    slice_start = np.minimum(np.maximum(fidx - window, 0), len(score_array))
+    slice_end = np.maximum(np.minimum(fidx + window, len(score_array)), slice_start)
+    counts = slice_end - slice_start
+
+    sums = cumulative[slice_end] - cumulative[slice_start]
+    return np.divide(sums, counts, out=np.zeros(track_length), where=counts > 0)
+
+
+def select_speaker_per_frame(tracks, scores, num_frames: int, window: int = 30):
+    """Pick the highest smoothed-score face for every frame.
+
+    Returns the face centre x per frame, NaN where no face scores >= 0. Ties go
+    to the lowest track index, matching max() over faces appended in track order.
+    """
+    num_tracks = max(len(tracks), 1)
+    score_matrix = np.full((num_frames, num_tracks), -np.inf)
+    x_matrix = np.zeros_like(score_matrix)
+    fidx_matrix = np.full((num_frames, num_tracks), -1, dtype=np.int64)
 
     for tidx, track in enumerate(tracks):
-        score_array = scores[tidx]
-        for fidx, frame in enumerate(track["track"]["frame"].tolist()):
-            slice_start = max(fidx - 30, 0)
-            slice_end = min(fidx + 30, len(score_array))
-            score_slice = score_array[slice_start:slice_end]
-            avg_score = float(np.mean(score_slice)
-                              if len(score_slice) > 0 else 0)
+        frames = np.asarray(track["track"]["frame"], dtype=np.int64)
+        in_range = (frames >= 0) & (frames < num_frames)
+        smoothed = smooth_track_scores(scores[tidx], len(frames), window)
+        score_matrix[frames[in_range], tidx] = smoothed[in_range]
+        x_matrix[frames[in_range], tidx] = np.asarray(track["proc_track"]["x"], dtype=np.float64)[in_range]
+        fidx_matrix[frames[in_range], tidx] = np.flatnonzero(in_range)
+
+    # ASD scores are rounded to 0.1, so exact ties and zero means are common and
+    # cumsum rounding noise could flip them. Re-evaluate those rows with the
+    # original per-slice np.mean so decisions stay identical.
+    if num_tracks > 1:
+        top_two = np.partition(score_matrix, num_tracks - 2, axis=1)[:, -2:]
+        runner_up, best = top_two[:, 0], top_two[:, 1]
+    else:
+        runner_up, best = np.full(num_frames, -np.inf), score_matrix[:, 0]
+    tolerance = 1e-9 * np.maximum(1.0, np.abs(np.nan_to_num(best, neginf=0.0)))
+    with np.errstate(invalid="ignore"):
+        ambiguous = np.isfinite(best) & ((best - runner_up <= tolerance) | (np.abs(best) <= tolerance))
+    for frame in np.flatnonzero(ambiguous):
+        for tidx in np.flatnonzero(fidx_matrix[frame] >= 0):
+            fidx = fidx_matrix[frame, tidx]
+            score_array = scores[tidx]
+            score_slice = score_array[max(fidx - window, 0):min(fidx + window, len(score_array))]
+            score_matrix[frame, tidx] = float(np.mean(score_slice)) if len(score_slice) > 0 else 0.0
+
+    rows = np.arange(num_frames)
+    best_track = np.argmax(score_matrix, axis=1)
+    best_score = score_matrix[rows, best_track]
+    return np.where(best_score >= 0, x_matrix[rows, best_track], np.nan)
+
+
+class ResizeFrameRenderer:
+    """Letterboxes frames over a blurred copy of themselves ("resize" mode).
+
+    Geometry and output buffers are set up once per source frame size; every
+    frame is written into the same preallocated output array.
+    """
+
+    def __init__(self, frame_width: int, frame_height: int, target_width: int = 1080, target_height: int = 1920,
+                 blur_scale: float = background_blur_scale, blur_kernel: int = 121):
+        self.frame_size = (frame_width, frame_height)
+        self.target_width = target_width
+        self.target_height = target_height
+
+        scale = target_width / frame_width
+        self.resized_height = int(frame_height * scale)
+        self.center_y = (target_height - self.resized_height) // 2
+
+        scale_for_bg = max(target_width / frame_width, target_height / frame_height)
+        self.bg_width = int(frame_width * scale_for_bg)
+        self.bg_height = int(frame_height * scale_for_bg)
+        self.crop_x = (self.bg_width - target_width) // 2
+        self.crop_y = (self.bg_height - target_height) // 2
+
+        self.blur_scale = min(max(blur_scale, 0.01), 1.0)
+        if self.blur_scale < 1.0:
+            small_width = max(1, round(self.bg_width * self.blur_scale))
+            small_height = max(1, round(self.bg_height * self.blur_scale))
+            self.blur_kernel = max(3, int(blur_kernel * self.blur_scale) | 1)
+            self.small = np.empty((small_height, small_width, 3), dtype=np.uint8)
+            self.small_blurred = np.empty_like(self.small)
+            x0 = round(self.crop_x * small_width / self.bg_width)
+            y0 = round(self.crop_y * small_height / self.bg_height)
+            x1 = max(x0 + 1, round((self.crop_x + target_width) * small_width / self.bg_width))
+            y1 = max(y0 + 1, round((self.crop_y + target_height) * small_height / self.bg_height))
+            self.small_crop = (slice(y0, y1), slice(x0, x1))
+        else:
+            self.blur_kernel = blur_kernel
+            self.background = np.empty((self.bg_height, self.bg_width, 3), dtype=np.uint8)
+
+        self.output = np.empty((target_height, target_width, 3), dtype=np.uint8)
+        self.foreground = self.output[self.center_y:self.center_y + self.resized_height]
+
+    def render(self, img):
+        if self.blur_scale < 1.0:
+            cv2.resize(img, (self.small.shape[1], self.small.shape[0]), dst=self.small,
+                       interpolation=cv2.INTER_AREA)
+            cv2.GaussianBlur(self.small, (self.blur_kernel, self.blur_kernel), 0, dst=self.small_blurred)
+            cv2.resize(self.small_blurred[self.small_crop], (self.target_width, self.target_height),
+                       dst=self.output, interpolation=cv2.INTER_LINEAR)
+        else:
+            cv2.resize(img, (self.bg_width, self.bg_height), dst=self.background)
+            cv2.GaussianBlur(self.background, (self.blur_kernel, self.blur_kernel), 0, dst=self.background)
+            self.output[:] = self.background[self.crop_y:self.crop_y + self.target_height,
+                                             self.crop_x:self.crop_x + self.target_width]
 
-            faces[frame].append(
-                {'track': tidx, 'score': avg_score, 's': track['proc_track']["s"][fidx], 'x': track['proc_track']["x"][fidx], 'y': track['proc_track']["y"][fidx]})
+        cv2.resize(img, (self.target_width, self.resized_height), dst=self.foreground,
+                   interpolation=cv2.INTER_AREA)
+        return self.output
+
+
+def create_vertical_video(tracks, scores, pyframes_path, pyavi_path, audio_path, output_path, framerate=25, video_path=None,
+                          single_pass=False, subtitle_path=None):
+    target_width = 1080
+    target_height = 1920
+
+    if video_path is not None:
+        video_info = probe_video(video_path)
+        num_frames = round(video_info["duration"] * framerate) or (video_info["nb_frames"] or 0)
+        frames = read_video_frames(video_path, framerate)
+    else:
+        flist = glob.glob(os.path.join(pyframes_path, "*.jpg"))
+        flist.sort()
+        num_frames = len(flist)
+        frames = _iter_frame_files(flist)
+
+    last_track_frame = max((int(track["track"]["frame"][-1]) for track in tracks
+                            if len(track["track"]["frame"])), default=-1)
+    speaker_x = select_speaker_per_frame(tracks, scores, max(num_frames, last_track_frame + 1))
 
     temp_video_path = os.path.join(pyavi_path, "video_only.mp4")
 
     vout = None
-    for fidx, fname in tqdm(enumerate(flist), total=len(flist), desc="Creating vertical video"):
-        img = cv2.imread(fname)
+    resize_renderer = None
+    for fidx, img in tqdm(enumerate(frames), total=num_frames, desc="Creating vertical video"):
         if img is None:
             continue
 
-        current_faces = faces[fidx]
-
-        max_score_face = max(
-            current_faces, key=lambda face: face['score']) if current_faces else None
-
-        if max_score_face and max_score_face['score'] < 0:
-            max_score_face = None
+        face_x = speaker_x[fidx] if fidx < len(speaker_x) else np.nan
 
-        if vout is None:
-            vout = ffmpegcv.VideoWriterNV(
-                file=temp_video_path,
-                codec=None,
-                fps=framerate,
-                resize=(target_width, target_height)
-            )
+        if vout is None and single_pass:
+            vout = FfmpegPipeWriter(output_path, target_width, target_height, framerate, video_encoder,
+                                    audio_path=audio_path, subtitle_path=subtitle_path)
+        elif vout is None:
+            vout = FfmpegPipeWriter(temp_video_path, target_width, target_height, framerate, video_encoder,
+                                    profile="intermediate")
 
-        if max_score_face:
+        if not np.isnan(face_x):
             mode = "crop"
         else:
             mode = "resize"
 
         if mode == "resize":
-            scale = target_width / img.shape[1]
-            resized_height = int(img.shape[0] * scale)
-            resized_image = cv2.resize(
-                img, (target_width, resized_height), interpolation=cv2.INTER_AREA)
-
-            scale_for_bg = max(
-                target_width / img.shape[1], target_height / img.shape[0])
-            bg_width = int(img.shape[1] * scale_for_bg)
-            bg_heigth = int(img.shape[0] * scale_for_bg)
-
-            blurred_background = cv2.resize(img, (bg_width, bg_heigth))
-            blurred_background = cv2.GaussianBlur(
-                blurred_background, (121, 121), 0)
-
-            crop_x = (bg_width - target_width) // 2
-            crop_y = (bg_heigth - target_height) // 2
-            blurred_background = blurred_background[crop_y:crop_y +
-                                                    target_height, crop_x:crop_x + target_width]
-
-            center_y = (target_height - resized_height) // 2
-            blurred_background[center_y:center_y +
-                               resized_height, :] = resized_image
-
-            vout.write(blurred_background)
+            if resize_renderer is None or resize_renderer.frame_size != (img.shape[1], img.shape[0]):
+                resize_renderer = ResizeFrameRenderer(img.shape[1], img.shape[0], target_width, target_height)
+            vout.write(resize_renderer.render(img))
 
         elif mode == "crop":
             scale = target_height / img.shape[0]
@@ -128,8 +625,7 @@ def create_vertical_video(tracks, scores, pyframes_path, pyavi_path, audio_path,
                 img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
             frame_width = resized_image.shape[1]
 
-            center_x = int(
-                max_score_face["x"] * scale if max_score_face else frame_width // 2)
+            center_x = int(face_x * scale)
             top_x = max(min(center_x - target_width // 2,
                         frame_width - target_width), 0)
 
@@ -141,138 +637,919 @@ def create_vertical_video(tracks, scores, pyframes_path, pyavi_path, audio_path,
     if vout:
         vout.release()
 
+    if single_pass:
+        return
+
+    # Only the audio is new here; the subtitle burn re-encodes the video afterwards anyway
     ffmpeg_command = (f"ffmpeg -y -i {temp_video_path} -i {audio_path} "
-                      f"-c:v h264 -preset fast -crf 23 -c:a aac -b:a 128k "
+                      f"-c:v copy -c:a aac -b:a 128k "
                       f"{output_path}")
     subprocess.run(ffmpeg_command, shell=True, check=True, text=True)
 
 
-def create_subtitles_with_ffmpeg(transcript_segments: list, clip_start: float, clip_end: float, clip_video_path: str, output_path: str, max_words: int = 5):
-    temp_dir = os.path.dirname(output_path)
-    subtitle_path = os.path.join(temp_dir, "temp_subtitles.ass")
+class SubtitleEngine:
+    """Renders the burned-in ASS subtitles for clip time ranges.
+
+    The script header (1080x1920 canvas and the Anton "Default" style) is
+    built once; a clip only formats its Dialogue lines, taking its words from
+    Transcript.words_between.
+    """
+
+    def __init__(self, fontsize: int = 140, scratch_dir=None):
+        subs = pysubs2.SSAFile()
+
+        subs.info["WrapStyle"] = 0
+        subs.info["ScaledBorderAndShadow"] = "yes"
+        subs.info["PlayResX"] = 1080
+        subs.info["PlayResY"] = 1920
+        subs.info["ScriptType"] = "v4.00+"
+
+        style_name = "Default"
+        new_style = pysubs2.SSAStyle()
+        new_style.fontname = "Anton"
+        new_style.fontsize = fontsize
+        new_style.primarycolor = pysubs2.Color(255, 255, 255)
+        new_style.outline = 2.0
+        new_style.shadow = 2.0
+        new_style.shadowcolor = pysubs2.Color(0, 0, 0, 128)
+        new_style.alignment = 2
+        new_style.marginl = 50
+        new_style.marginr = 50
+        new_style.marginv = 50
+        new_style.spacing = 0.0
+
+        subs.styles[style_name] = new_style
+        self.style_name = style_name
+        self.header = subs.to_string("ass")
+        # tmpfs keeps the per-clip .ass files in memory; ffmpeg's ass filter needs a path
+        self.scratch_dir = pathlib.Path(scratch_dir or ("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()))
+
+    def events(self, transcript: Transcript, clip_start: float, clip_end: float, max_words: int = 5) -> list:
+        """(start, end, text) lines relative to clip_start, max_words words per line."""
+        subtitles = []
+        current_words = []
+        current_start = None
+        current_end = None
+
+        for index in transcript.words_between(clip_start, clip_end):
+            word = transcript.words[index].strip()
+            seg_start = float(transcript.starts[index])
+            seg_end = float(transcript.ends[index])
+
+            if not word:
+                continue
+
+            start_rel = max(0.0, seg_start - clip_start)
+            end_rel = max(0.0, seg_end - clip_start)
+
+            if end_rel <= 0:
+                continue
+
+            if not current_words:
+                current_start = start_rel
+                current_end = end_rel
+                current_words = [word]
+            elif len(current_words) >= max_words:
+                subtitles.append(
+                    (current_start, current_end, ' '.join(current_words)))
+                current_words = [word]
+                current_start = start_rel
+                current_end = end_rel
+            else:
+                current_words.append(word)
+                current_end = end_rel
+
+        if current_words:
+            subtitles.append(
+                (current_start, current_end, ' '.join(current_words)))
+        return subtitles
+
+    @staticmethod
+    def timestamp(seconds: float) -> str:
+        # Same rounding as pysubs2.make_time + its ASS writer: to ms, then to the nearest centisecond
+        ms = max(0, int(round(seconds * 1000)))
+        ms = (ms + 5) - (ms + 5) % 10
+        hours, ms = divmod(ms, 3600000)
+        minutes, ms = divmod(ms, 60000)
+        secs, ms = divmod(ms, 1000)
+        return f"{hours:01d}:{minutes:02d}:{secs:02d}.{ms // 10:02d}"
+
+    def render(self, transcript: Transcript, clip_start: float, clip_end: float, max_words: int = 5) -> str:
+        lines = [f"Dialogue: 0,{self.timestamp(start)},{self.timestamp(end)},{self.style_name},,0,0,0,,{text}\n"
+                 for start, end, text in self.events(transcript, clip_start, clip_end, max_words)]
+        return self.header + "".join(lines)
+
+    def render_many(self, transcript: Transcript, moments: list, max_words: int = 5) -> list:
+        """One ASS document per moment, in moment order; None for moments without start/end."""
+        documents = []
+        for moment in moments:
+            try:
+                documents.append(self.render(transcript, float(moment["start"]), float(moment["end"]), max_words))
+            except (KeyError, TypeError, ValueError):
+                documents.append(None)
+        return documents
 
-    clip_segments = [segment for segment in transcript_segments
-                     if segment.get("start") is not None
-                     and segment.get("end") is not None
-                     and segment.get("end") > clip_start
-                     and segment.get("start") < clip_end
-                     ]
+    def write_temp(self, ass_text: str, prefix: str = "subtitles") -> pathlib.Path:
+        """Write ass_text to a uniquely named scratch file; the caller unlinks it."""
+        subtitle_path = self.scratch_dir / f"{prefix}-{uuid.uuid4().hex}.ass"
+        subtitle_path.write_text(ass_text, encoding="utf-8")
+        return subtitle_path
 
-    subtitles = []
-    current_words = []
-    current_start = None
-    current_end = None
 
-    for segment in clip_segments:
-        word = segment.get("word", "").strip()
-        seg_start = segment.get("start")
-        seg_end = segment.get("end")
+subtitle_engine = SubtitleEngine()
 
-        if not word or seg_start is None or seg_end is None:
-            continue
 
-        start_rel = max(0.0, seg_start - clip_start)
-        end_rel = max(0.0, seg_end - clip_start)
+class DiskCache:
+    """Size-bounded key/value file cache on the Modal volume.
 
-        if end_rel <= 0:
-            continue
+    Entries are written atomically; reads touch the file so eviction drops the
+    least recently used entries once the directory exceeds max_bytes.
+    """
 
-        if not current_words:
-            current_start = start_rel
-            current_end = end_rel
-            current_words = [word]
-        elif len(current_words) >= max_words:
-            subtitles.append(
-                (current_start, current_end, ' '.join(current_words)))
-            current_words = [word]
-            current_start = start_rel
-            current_end = end_rel
-        else:
-            current_words.append(word)
-            current_end = end_rel
-
-    if current_words:
-        subtitles.append(
-            (current_start, current_end, ' '.join(current_words)))
-
-    subs = pysubs2.SSAFile()
-
-    subs.info["WrapStyle"] = 0
-    subs.info["ScaledBorderAndShadow"] = "yes"
-    subs.info["PlayResX"] = 1080
-    subs.info["PlayResY"] = 1920
-    subs.info["ScriptType"] = "v4.00+"
-
-    style_name = "Default"
-    new_style = pysubs2.SSAStyle()
-    new_style.fontname = "Anton"
-    new_style.fontsize = 140
-    new_style.primarycolor = pysubs2.Color(255, 255, 255)
-    new_style.outline = 2.0
-    new_style.shadow = 2.0
-    new_style.shadowcolor = pysubs2.Color(0, 0, 0, 128)
-    new_style.alignment = 2
-    new_style.marginl = 50
-    new_style.marginr = 50
-    new_style.marginv = 50
-    new_style.spacing = 0.0
-
-    subs.styles[style_name] = new_style
-
-    for i, (start, end, text) in enumerate(subtitles):
-        start_time = pysubs2.make_time(s=start)
-        end_time = pysubs2.make_time(s=end)
-        line = pysubs2.SSAEvent(
-            start=start_time, end=end_time, text=text, style=style_name)
-        subs.events.append(line)
-
-    subs.save(subtitle_path)
-
-    ffmpeg_cmd = (f"ffmpeg -y -i {clip_video_path} -vf \"ass={subtitle_path}\" "
-                  f"-c:v h264 -preset fast -crf 23 {output_path}")
-
-    subprocess.run(ffmpeg_cmd, shell=True, check=True)
-
-def process_clip(base_dir: str, original_video_path: str, s3_key: str, start_time: float, end_time: float, clip_index: int, transcript_segments: list):
-    clip_name = f"clip_{clip_index}"
-    s3_key_dir = os.path.dirname(s3_key)
-    output_s3_key = f"{s3_key_dir}/{clip_name}.mp4"
-    print(f"Output S3 key: {output_s3_key}")
+    def __init__(self, cache_dir, max_bytes: int, suffix: str = ".json"):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.lock = threading.Lock()
 
-    clip_dir = base_dir / clip_name
-    clip_dir.mkdir(parents=True, exist_ok=True)
+    def _path(self, key: str):
+        return self.cache_dir / f"{key}{self.suffix}"
 
-    clip_segment_path = clip_dir / f"{clip_name}_segment.mp4"
-    vertical_mp4_path = clip_dir / "pyavi" / "video_out_vertical.mp4"
-    subtitle_output_path = clip_dir / "pyavi" / "video_with_subtitles.mp4"
+    def get(self, key: str):
+        path = self._path(key)
+        if not path.exists():
+            try:
+                # Another container may have written it since we mounted
+                volume.reload()
+            except Exception as e:
+                print("[WARN] Could not reload volume:", repr(e))
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return data
+
+    def put(self, key: str, data: bytes):
+        with self.lock:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            temp_path = self.cache_dir / f".{key}.{uuid.uuid4().hex}.tmp"
+            temp_path.write_bytes(data)
+            os.replace(temp_path, self._path(key))
+            self.evict()
+        try:
+            volume.commit()
+        except Exception as e:
+            print("[WARN] Could not commit volume:", repr(e))
 
-    (clip_dir / "pywork").mkdir(exist_ok=True)
-    pyframes_path = clip_dir / "pyframes"
-    pyavi_path = clip_dir / "pyavi"
-    audio_path = clip_dir / "pyavi" / "audio.wav"
+    def evict(self):
+        entries = []
+        for path in self.cache_dir.glob(f"*{self.suffix}"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+
+def transcript_cache_key(source_id: str) -> str:
+    settings = {
+        "source": source_id,
+        "model": whisperx_model_name,
+        "compute_type": whisperx_compute_type,
+        "batch_size": whisperx_batch_size,
+        "alignment_language": alignment_language,
+        "transcribe_mode": transcribe_mode,
+        "transcribe_chunk_s": transcribe_chunk_s if transcribe_mode == "vad_chunked" else None,
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
 
-    pyframes_path.mkdir(exist_ok=True)
-    pyavi_path.mkdir(exist_ok=True)
 
-    duration = end_time - start_time
-    cut_command = (f"ffmpeg -i {original_video_path} -ss {start_time} -t {duration} "
-                   f"{clip_segment_path}")
-    subprocess.run(cut_command, shell=True, check=True,
-                   capture_output=True, text=True)
+def file_sha256(path, chunk_size: int = 8 * 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-    extract_cmd = f"ffmpeg -i {clip_segment_path} -vn -acodec pcm_s16le -ar 16000 -ac 1 {audio_path}"
-    subprocess.run(extract_cmd, shell=True,
-                   check=True, capture_output=True)
 
-    shutil.copy(clip_segment_path, base_dir / f"{clip_name}.mp4")
+transcript_cache = DiskCache(pathlib.Path(mount_path) / "transcripts", transcript_cache_max_bytes, suffix=".npz")
+
+
+class RunCheckpoint:
+    """Finished stages of one job, kept on the volume so a retry resumes where
+    the last attempt stopped.
+
+    checkpoint.json holds the source ETag, the moments and each clip's upload;
+    the transcript and per-clip tracks/scores are files next to it. Binding a
+    different source ETag starts the checkpoint over. Runs open it with claim(),
+    so two containers working on the same key never share the directory.
+    """
+
+    def __init__(self, job_id: str, root=checkpoint_dir):
+        self.job_id = job_id
+        self.lease = None
+        self.path = pathlib.Path(root) / job_id
+        self.lock = threading.Lock()
+        try:
+            volume.reload()
+        except Exception as e:
+            print("[WARN] Could not reload volume:", repr(e))
+        self.evict(root, keep=job_id)
+        self.state = {"job_id": job_id, "clips": {}}
+        try:
+            self.state = json.loads((self.path / "checkpoint.json").read_text())
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"[WARN] Ignoring unreadable checkpoint for {job_id}:", repr(e))
+
+    @classmethod
+    def claim(cls, job_id: str, leases=jobs, lease_s: float = job_stale_after_s):
+        """Open job_id's checkpoint for this run, or None while another live run holds it.
+
+        The lease is an entry in the jobs Dict that expires after lease_s, longer
+        than any run can take, so a lost run's checkpoint can be claimed again.
+        """
+        lease_key = f"{job_id}:checkpoint-lease"
+        owner = uuid.uuid4().hex
+        lease = {"owner": owner, "expires_at": time.time() + lease_s}
+        if not leases.put(lease_key, lease, skip_if_exists=True):
+            current = leases.get(lease_key)
+            if current is not None and current.get("expires_at", 0) > time.time():
+                print(f"[WARN] Checkpoint of {job_id} is held by another run; running without it")
+                return None
+            if current is None:
+                # Released between the two calls
+                claimed = leases.put(lease_key, lease, skip_if_exists=True)
+            else:
+                # Only one run may take over a given expired lease
+                claimed = leases.put(f"{lease_key}:{current.get('owner')}:taken", True, skip_if_exists=True)
+                if claimed:
+                    leases[lease_key] = lease
+            if not claimed:
+                print(f"[WARN] Checkpoint of {job_id} was claimed by another run; running without it")
+                return None
+        checkpoint = cls(job_id)
+        checkpoint.lease = (leases, lease_key, owner)
+        return checkpoint
+
+    def release(self):
+        if self.lease is None:
+            return
+        leases, lease_key, owner = self.lease
+        self.lease = None
+        try:
+            if (leases.get(lease_key) or {}).get("owner") == owner:
+                leases.pop(lease_key)
+        except Exception as e:
+            print(f"[WARN] Could not release checkpoint lease of {self.job_id}:", repr(e))
+
+    def _save(self):
+        # Callers hold self.lock
+        self.path.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path / f".checkpoint.{uuid.uuid4().hex}.tmp"
+        temp_path.write_text(json.dumps(self.state))
+        os.replace(temp_path, self.path / "checkpoint.json")
+        try:
+            volume.commit()
+        except Exception as e:
+            print("[WARN] Could not commit volume:", repr(e))
+
+    def _write(self, name: str, data: bytes):
+        self.path.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path / f".{name}.{uuid.uuid4().hex}.tmp"
+        temp_path.write_bytes(data)
+        os.replace(temp_path, self.path / name)
+
+    def bind_source(self, source_etag: str):
+        with self.lock:
+            previous = self.state.get("source_etag")
+            if previous and source_etag and previous != source_etag:
+                print(f"[WARN] Source changed since the last attempt of {self.job_id}; starting over")
+                shutil.rmtree(self.path, ignore_errors=True)
+                self.state = {"job_id": self.job_id, "clips": {}}
+            if source_etag and previous == source_etag:
+                print(f"Resuming {self.job_id} from checkpoint: {self.summary()}")
+            self.state["source_etag"] = source_etag
+            self._save()
+
+    def summary(self) -> dict:
+        clips = self.state.get("clips", {}).values()
+        return {"transcript": bool(self.state.get("transcript")), "moments": "moments" in self.state,
+                "clips_asd": sum(1 for clip in clips if clip.get("asd")),
+                "clips_uploaded": sum(1 for clip in clips if clip.get("s3_key"))}
+
+    def transcript(self) -> Transcript | None:
+        if not self.state.get("transcript"):
+            return None
+        try:
+            return Transcript.from_bytes((self.path / "transcript.npz").read_bytes())
+        except Exception as e:
+            print("[WARN] Could not load checkpointed transcript:", repr(e))
+            return None
+
+    def save_transcript(self, transcript: Transcript):
+        with self.lock:
+            self._write("transcript.npz", transcript.to_bytes())
+            self.state["transcript"] = True
+            self._save()
+
+    def moments(self) -> list | None:
+        return self.state.get("moments")
+
+    def save_moments(self, clip_moments: list):
+        with self.lock:
+            self.state["moments"] = clip_moments
+            self._save()
+
+    def _clip(self, clip_index: int, start_time: float, end_time: float) -> dict | None:
+        clip = self.state.get("clips", {}).get(str(clip_index))
+        if clip and clip["start"] == start_time and clip["end"] == end_time:
+            return clip
+        return None
+
+    def clip_output(self, clip_index: int, start_time: float, end_time: float) -> str | None:
+        clip = self._clip(clip_index, start_time, end_time)
+        return clip.get("s3_key") if clip else None
+
+    def clip_asd(self, clip_index: int, start_time: float, end_time: float):
+        clip = self._clip(clip_index, start_time, end_time)
+        if not clip or not clip.get("asd"):
+            return None
+        try:
+            with open(self.path / clip["asd"], "rb") as f:
+                return pickle.load(f)
+        except Exception as e:
+            print(f"[WARN] Could not load checkpointed ASD for clip {clip_index}:", repr(e))
+            return None
+
+    def _update_clip(self, clip_index: int, start_time: float, end_time: float, **fields):
+        clips = self.state.setdefault("clips", {})
+        clip = self._clip(clip_index, start_time, end_time) or {"start": start_time, "end": end_time}
+        clip.update(fields)
+        clips[str(clip_index)] = clip
+        self._save()
+
+    def save_clip_asd(self, clip_index: int, start_time: float, end_time: float, tracks, scores):
+        with self.lock:
+            name = f"clip_{clip_index}_asd.pckl"
+            self._write(name, pickle.dumps((tracks, scores)))
+            self._update_clip(clip_index, start_time, end_time, asd=name)
+
+    def save_clip_output(self, clip_index: int, start_time: float, end_time: float, s3_key: str):
+        with self.lock:
+            self._update_clip(clip_index, start_time, end_time, s3_key=s3_key)
+
+    @staticmethod
+    def evict(root=checkpoint_dir, keep: str | None = None, ttl_s: float = checkpoint_ttl_s,
+              max_bytes: int = checkpoint_max_bytes, leases=jobs):
+        """Drop checkpoints not written for ttl_s, then the least recently written
+        ones until the rest fit in max_bytes. Checkpoints under a live lease
+        (a run in another container) are never dropped."""
+        entries = []
+        for path in pathlib.Path(root).glob("*"):
+            if not path.is_dir() or path.name == keep:
+                continue
+            try:
+                files = [file.stat() for file in path.iterdir()]
+            except FileNotFoundError:
+                continue
+            last_write = max((stat.st_mtime for stat in files), default=path.stat().st_mtime)
+            entries.append((last_write, sum(stat.st_size for stat in files), path))
+
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        evicted = False
+        for last_write, size, path in sorted(entries):
+            if now - last_write <= ttl_s and total <= max_bytes:
+                break
+            try:
+                lease = leases.get(f"{path.name}:checkpoint-lease")
+            except Exception as e:
+                print(f"[WARN] Could not check the lease of checkpoint {path.name}; keeping it:", repr(e))
+                continue
+            if lease is not None and lease.get("expires_at", 0) > now:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            evicted = True
+        if evicted:
+            try:
+                volume.commit()
+            except Exception as e:
+                print("[WARN] Could not commit volume:", repr(e))
+
+    def clear(self):
+        with self.lock:
+            shutil.rmtree(self.path, ignore_errors=True)
+            try:
+                volume.commit()
+            except Exception as e:
+                print("[WARN] Could not commit volume:", repr(e))
+
+
+def snap_moments_to_keyframes(moments: list, transcript: Transcript, keyframe_index: KeyframeIndex,
+                              max_shift: float = 2.0) -> list:
+    """Move each moment's start back onto a keyframe when one falls in the pause before it.
+
+    The keyframe must come after the previous word ends and at most max_shift
+    before the start, so no speech is gained or lost; cut_segment can then
+    copy the clip instead of re-encoding it.
+    """
+    snapped = []
+    for moment in moments:
+        if isinstance(moment, dict) and "start" in moment and "end" in moment:
+            start = float(moment["start"])
+            keyframe = keyframe_index.keyframe_at_or_before(start)
+            position = int(np.searchsorted(transcript.starts, start, side="left"))
+            previous_end = float(transcript.ends_prefix_max[position - 1]) if position else 0.0
+            if keyframe is not None and start - keyframe <= max_shift and keyframe >= previous_end:
+                moment = {**moment, "start": keyframe}
+        snapped.append(moment)
+    return snapped
+
+
+def parse_moments_json(text: str) -> list:
+    """Parse the LLM's moment list, tolerating ```json fences. Raises ValueError."""
+    cleaned_json_string = text.strip()
+    if cleaned_json_string.startswith("```json"):
+        cleaned_json_string = cleaned_json_string[len("```json"):].strip()
+    if cleaned_json_string.endswith("```"):
+        cleaned_json_string = cleaned_json_string[:-len("```")].strip()
+    try:
+        clip_moments = json.loads(cleaned_json_string)
+    except Exception as e:
+        print("[ERROR] Failed to parse moments JSON:", cleaned_json_string)
+        raise ValueError(f"Gemini output could not be parsed as JSON: {e}") from e
+    if not isinstance(clip_moments, list):
+        print("[WARN] Identified moments is not a list:", cleaned_json_string)
+        return []
+    return clip_moments
+
+
+def validate_moments(clip_moments: list) -> list:
+    """Keep only {start, end} dicts with numeric, increasing times."""
+    valid = []
+    for moment in clip_moments:
+        if not isinstance(moment, dict):
+            continue
+        try:
+            start, end = float(moment["start"]), float(moment["end"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if end > start >= 0:
+            valid.append({**moment, "start": start, "end": end})
+    return valid
+
+
+def moment_cache_key(transcript: Transcript, model_name: str) -> str:
+    identity = {
+        "transcript": hashlib.sha256(serialize_transcript(transcript).encode()).hexdigest(),
+        "prompt_version": moment_prompt_version,
+        "model": model_name,
+    }
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+
+class MomentCache:
+    """Two-level cache of validated moment lists: an in-memory LRU in front of
+    a DiskCache on the volume. Entries older than ttl_s count as misses."""
+
+    def __init__(self, disk_cache: DiskCache, ttl_s: float, max_memory_entries: int):
+        self.disk_cache = disk_cache
+        self.ttl_s = ttl_s
+        self.max_memory_entries = max_memory_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "expired": 0, "puts": 0}
+
+    def _count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def _remember(self, key: str, entry: dict):
+        with self.lock:
+            self.memory[key] = entry
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_memory_entries:
+                self.memory.popitem(last=False)
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+        level = "memory_hits"
+        if entry is None:
+            data = self.disk_cache.get(key)
+            entry = json.loads(data) if data is not None else None
+            level = "disk_hits"
+        if entry is None:
+            self._count("misses")
+            return None
+        if time.time() - entry["created_at"] > self.ttl_s:
+            with self.lock:
+                self.memory.pop(key, None)
+            self._count("expired")
+            self._count("misses")
+            return None
+        if level == "disk_hits":
+            self._remember(key, entry)
+        self._count(level)
+        return copy.deepcopy(entry["moments"])
+
+    def put(self, key: str, moments: list):
+        entry = {"created_at": time.time(), "moments": moments}
+        self._remember(key, entry)
+        self.disk_cache.put(key, json.dumps(entry).encode())
+        self._count("puts")
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counters)
+            stats["memory_entries"] = len(self.memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def publish(self, store=cache_stats_store, owner: str = container_id):
+        """Write this container's counters to the shared stats Dict."""
+        try:
+            store[f"moment_cache:{owner}"] = {**self.stats(), "updated_at": time.time()}
+        except Exception as e:
+            print("[WARN] Could not publish moment cache stats:", repr(e))
+
+
+def merge_cache_stats(records: list) -> dict:
+    """Sum per-container MomentCache.stats() snapshots into one."""
+    merged = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "expired": 0, "puts": 0, "memory_entries": 0}
+    for record in records:
+        for name in merged:
+            merged[name] += record.get(name, 0)
+    lookups = merged["memory_hits"] + merged["disk_hits"] + merged["misses"]
+    merged["hit_rate"] = (merged["memory_hits"] + merged["disk_hits"]) / lookups if lookups else 0.0
+    merged["containers"] = len(records)
+    return merged
+
+
+moment_cache = MomentCache(DiskCache(pathlib.Path(mount_path) / "moments", moment_cache_max_bytes),
+                           moment_cache_ttl_s, moment_cache_memory_entries)
+
+
+class HeuristicMomentEngine:
+    """Picks clip moments locally from word timestamps and the source audio.
+
+    Candidates start at a sentence boundary and end at a later one 30-60 s on.
+    Each is scored by how clean its two cut points are (pause length and
+    loudness dip in audio.wav) plus a bonus for opening on a question that is
+    followed by an answer. The best non-overlapping candidates win.
+    """
+
+    question_bonus = 1.0
+    filler_penalty = 1.0
+    filler_words = ("thank", "welcome", "subscribe", "goodbye", "bye", "sponsor")
+
+    def __init__(self, min_duration: float = 30.0, max_duration: float = 60.0, energy_window: float = 0.15):
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+        self.energy_window = energy_window
+
+    def _rms(self, source_audio: SourceAudio, time_s: float) -> float:
+        samples = source_audio.slice(time_s - self.energy_window, time_s + self.energy_window)
+        if len(samples) == 0:
+            return 0.0
+        return float(np.sqrt(np.mean(np.square(samples, dtype=np.float64))))
+
+    def boundary_scores(self, transcript: Transcript, spans: list, source_audio: SourceAudio | None = None):
+        """Score in [0, 1] for cutting before each sentence (index len(spans) is the end)."""
+        starts, ends = transcript.starts, transcript.ends
+        boundary_times = [starts[first] for first, _ in spans]
+        boundary_times.append(ends[spans[-1][1]])
+        pauses = [1.0]
+        for (_, last), (first, _) in zip(spans, spans[1:]):
+            pauses.append(starts[first] - ends[last])
+        pauses.append(1.0)
+        scores = np.clip(np.asarray(pauses, dtype=np.float64), 0.0, 1.0)
+        if source_audio is None:
+            return scores
+
+        # A quiet cut point is a cleaner one; compare with the typical level mid-sentence
+        boundary_rms = np.array([self._rms(source_audio, time_s) for time_s in boundary_times])
+        speech_rms = np.median([self._rms(source_audio, (starts[first] + ends[last]) / 2)
+                                for first, last in spans]) or 1.0
+        quietness = 1.0 - np.clip(boundary_rms / speech_rms, 0.0, 1.0)
+        return 0.6 * scores + 0.4 * quietness
+
+    def select(self, transcript: Transcript, source_audio: SourceAudio | None = None,
+               max_moments: int = max_clips_per_video) -> list:
+        if not len(transcript):
+            return []
+        starts, ends = transcript.starts.tolist(), transcript.ends.tolist()
+        spans = sentence_spans(transcript)
+        boundaries = self.boundary_scores(transcript, spans, source_audio)
+        texts = [" ".join(word.strip() for word in transcript.words[first:last + 1]).lower()
+                 for first, last in spans]
+        is_question = [text.endswith("?") for text in texts]
+
+        candidates = []
+        for i, (first, _) in enumerate(spans):
+            start = starts[first]
+            best = None
+            for j in range(i, len(spans)):
+                end = ends[spans[j][1]]
+                if end - start > self.max_duration:
+                    break
+                if end - start >= self.min_duration and (best is None or boundaries[j + 1] > boundaries[best + 1]):
+                    best = j
+            if best is None:
+                continue
+            score = boundaries[i] + boundaries[best + 1]
+            if is_question[i] and best > i and not is_question[i + 1]:
+                score += self.question_bonus
+            if any(filler in text for text in texts[i:best + 1] for filler in self.filler_words):
+                score -= self.filler_penalty
+            candidates.append((score, start, ends[spans[best][1]]))
+
+        chosen = []
+        for score, start, end in sorted(candidates, key=lambda candidate: -candidate[0]):
+            if len(chosen) >= max_moments:
+                break
+            if all(end <= other_start or start >= other_end for other_start, other_end in chosen):
+                chosen.append((start, end))
+        return [{"start": float(start), "end": float(end)} for start, end in sorted(chosen)]
+
+
+heuristic_moment_engine = HeuristicMomentEngine()
+
+
+def _process_io_bytes():
+    counters = {}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                counters[name] = int(value)
+    except OSError:
+        pass
+    return counters.get("read_bytes", 0), counters.get("write_bytes", 0)
+
+
+class StageTracer:
+    """Collects per-stage spans (wall, CPU, peak RSS, I/O) for one pipeline run.
+
+    cpu_s is the calling thread's CPU time. child_cpu_s, peak_rss_mb and the
+    byte counters come from process-wide counters (reaped ffmpeg/ASD children
+    included), so they overlap between clips that run concurrently.
+    """
+
+    def __init__(self, run_id: str | None = None, on_span=None):
+        self.run_id = run_id
+        self.spans = []
+        self.lock = threading.Lock()
+        self.on_span = on_span
+
+    @contextlib.contextmanager
+    def span(self, stage: str, clip_index: int | None = None, **tags):
+        record = {"run_id": self.run_id, "stage": stage, "clip_index": clip_index, **tags}
+        children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        read_before, write_before = _process_io_bytes()
+        cpu_before = time.thread_time()
+        wall_before = time.time()
+        record["start"] = wall_before
+        try:
+            yield record
+        except BaseException as e:
+            record["status"] = "error"
+            record["error"] = repr(e)
+            raise
+        else:
+            record.setdefault("status", "ok")
+        finally:
+            children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            read_after, write_after = _process_io_bytes()
+            record["wall_s"] = round(time.time() - wall_before, 4)
+            record["cpu_s"] = round(time.thread_time() - cpu_before, 4)
+            record["child_cpu_s"] = round((children_after.ru_utime + children_after.ru_stime)
+                                          - (children_before.ru_utime + children_before.ru_stime), 4)
+            # ru_maxrss is in KiB on Linux
+            record["peak_rss_mb"] = round(max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                              children_after.ru_maxrss) / 1024, 1)
+            record["read_bytes"] = read_after - read_before
+            record["write_bytes"] = write_after - write_before
+            with self.lock:
+                self.spans.append(record)
+            clip_label = f" clip {clip_index}" if clip_index is not None else ""
+            print(f"[TRACE] {stage}{clip_label} {record['status']} in {record['wall_s']:.2f}s")
+            if self.on_span is not None:
+                self.on_span(record)
+
+    def extend(self, records: list, **tags):
+        """Add spans recorded in another container (e.g. a render worker) to this run."""
+        for record in records:
+            record = {**record, **tags, "run_id": self.run_id}
+            with self.lock:
+                self.spans.append(record)
+            if self.on_span is not None:
+                self.on_span(record)
+
+    def write_jsonl(self, log_dir=trace_log_dir):
+        log_dir = pathlib.Path(log_dir)
+        try:
+            log_dir.mkdir(parents=True, exist_ok=True)
+            with open(log_dir / f"{self.run_id}.jsonl", "a") as f:
+                for record in self.spans:
+                    f.write(json.dumps(record, default=str) + "\n")
+            volume.commit()
+        except Exception as e:
+            print("[WARN] Could not write trace log:", repr(e))
+
+
+def make_s3_client(max_pool_connections: int | None = None):
+    config = BotoConfig(max_pool_connections=max_pool_connections) if max_pool_connections else None
+    return boto3.client("s3", endpoint_url=s3_endpoint_url, config=config)
+
+
+def local_s3_etag(path, chunk_size: int = s3_multipart_chunk_size, multipart_threshold: int = s3_multipart_chunk_size):
+    """(md5, etag) of a local file; etag is what S3 reports after an upload
+    with the given multipart settings."""
+    whole = hashlib.md5()
+    part_digests = []
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            whole.update(chunk)
+            part_digests.append(hashlib.md5(chunk).digest())
+    md5 = whole.hexdigest()
+    if os.path.getsize(path) < multipart_threshold:
+        return md5, md5
+    return md5, f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+
+class S3TransferManager:
+    """Container-wide S3 client with a pooled connection set and upload workers.
+
+    Created once in load_model so every download and upload reuses the same
+    keep-alive connections instead of paying a new TLS handshake per client.
+    """
+
+    def __init__(self, chunk_size: int = s3_multipart_chunk_size, max_concurrency: int = s3_max_concurrency,
+                 upload_workers: int = s3_upload_workers, max_pool_connections: int = s3_max_pool_connections):
+        self.client = make_s3_client(max_pool_connections)
+        self.chunk_size = chunk_size
+        self.transfer_config = TransferConfig(multipart_threshold=chunk_size, multipart_chunksize=chunk_size,
+                                              max_concurrency=max_concurrency, use_threads=True)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=upload_workers,
+                                                              thread_name_prefix="upload")
+
+    def upload(self, path, bucket: str, key: str) -> str:
+        """Upload path unless bucket/key already holds identical bytes.
+
+        Returns "skipped" or "uploaded".
+        """
+        md5, etag = local_s3_etag(path, self.chunk_size, self.chunk_size)
+        try:
+            head = self.client.head_object(Bucket=bucket, Key=key)
+        except self.client.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey", "NotFound"):
+                raise
+        else:
+            if head.get("Metadata", {}).get("md5") == md5 or head.get("ETag", "").strip('"') == etag:
+                print(f"[S3] {key} is already up to date in {bucket}. Skipping upload.")
+                return "skipped"
+
+        self.client.upload_file(str(path), bucket, key, Config=self.transfer_config,
+                                ExtraArgs={"Metadata": {"md5": md5}})
+        return "uploaded"
+
+    def submit(self, fn, *args, **kwargs):
+        return self.executor.submit(fn, *args, **kwargs)
+
+
+def mp4_is_streamable(head: bytes) -> bool:
+    """False when an MP4/MOV header shows mdat before moov (not faststart).
+
+    ffmpeg cannot demux such files from a pipe; anything that is not an
+    ISO-BMFF container is assumed to be streamable.
+    """
+    if head[4:8] != b"ftyp":
+        return True
+    offset = 0
+    while offset + 8 <= len(head):
+        box_size = int.from_bytes(head[offset:offset + 4], "big")
+        box_type = head[offset + 4:offset + 8]
+        if box_type == b"moov":
+            return True
+        if box_type == b"mdat":
+            return False
+        if box_size == 1 and offset + 16 <= len(head):
+            box_size = int.from_bytes(head[offset + 8:offset + 16], "big")
+        if box_size < 8:
+            break
+        offset += box_size
+    return False
+
+
+def ingest_source(s3_client, bucket: str, key: str, video_path, audio_path, content_length: int) -> bool:
+    """Download bucket/key to video_path with parallel ranged GETs.
+
+    The parts are written in order and, when the container allows streaming,
+    also piped into an ffmpeg process that extracts audio_path while the
+    download is still running. Returns True if audio_path was produced that
+    way; otherwise the caller extracts audio from the finished file.
+    """
+    def fetch(first: int):
+        last = min(first + ingest_part_size, content_length) - 1
+        for attempt in range(1, ingest_part_attempts + 1):
+            try:
+                return s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes={first}-{last}")["Body"].read()
+            except ClientError as e:
+                error = e.response.get("Error", {})
+                retryable = (e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500
+                             or error.get("Code") in ("SlowDown", "Throttling", "RequestTimeout"))
+                if not retryable or attempt == ingest_part_attempts:
+                    raise
+            except (BotoCoreError, OSError):
+                if attempt == ingest_part_attempts:
+                    raise
+            print(f"[WARN] Ranged GET of bytes {first}-{last} failed (attempt {attempt}), retrying")
+            time.sleep(min(2 ** attempt, 10))
+
+    part_starts = list(range(0, content_length, ingest_part_size))
+    audio_process = None
+    try:
+        with open(video_path, "wb") as video_file, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=ingest_concurrency) as executor:
+            pending = [executor.submit(fetch, first) for first in part_starts[:ingest_concurrency]]
+            next_part = len(pending)
+            try:
+                while pending:
+                    data = pending.pop(0).result()
+                    if next_part < len(part_starts):
+                        pending.append(executor.submit(fetch, part_starts[next_part]))
+                        next_part += 1
+
+                    if video_file.tell() == 0 and streaming_ingest and mp4_is_streamable(data[:1024 * 1024]):
+                        audio_process = subprocess.Popen(
+                            ["ffmpeg", "-y", "-v", "error", "-i", "pipe:0", "-vn", "-acodec", "pcm_s16le",
+                             "-ar", "16000", "-ac", "1", str(audio_path)],
+                            stdin=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+                    video_file.write(data)
+                    if audio_process is not None:
+                        try:
+                            audio_process.stdin.write(data)
+                        except BrokenPipeError:
+                            print("[WARN] Streaming audio extraction stopped early; will extract from the file")
+                            audio_process.wait()
+                            audio_process = None
+            except BaseException:
+                # Don't start parts nobody will read
+                for future in pending:
+                    future.cancel()
+                raise
+    except BaseException:
+        if audio_process is not None:
+            audio_process.kill()
+            with contextlib.suppress(OSError):
+                audio_process.stdin.close()
+            audio_process.wait()
+        raise
+
+    if audio_process is None:
+        return False
+    audio_process.stdin.close()
+    return audio_process.wait() == 0
+
 
+def create_subtitles_with_ffmpeg(transcript: Transcript, clip_start: float, clip_end: float, clip_video_path: str, output_path: str, max_words: int = 5,
+                                 ass_text: str | None = None):
+    if ass_text is None:
+        ass_text = subtitle_engine.render(transcript, clip_start, clip_end, max_words)
+    subtitle_path = subtitle_engine.write_temp(ass_text)
+
+    ffmpeg_cmd = (f"ffmpeg -y {' '.join(video_encoder.input_args())} -i {clip_video_path} "
+                  f"{video_encoder.encode_args([f'ass={subtitle_path}'])} {output_path}")
+
+    try:
+        subprocess.run(ffmpeg_cmd, shell=True, check=True)
+    finally:
+        subtitle_path.unlink(missing_ok=True)
+
+def run_columbia_script(base_dir, clip_name: str):
+    clip_dir = base_dir / clip_name
     columbia_command = (f"python Columbia_test.py --videoName {clip_name} "
                         f"--videoFolder {str(base_dir)} "
-                        f"--pretrainModel weight/finetuning_TalkSet.model")
+                        f"--pretrainModel {asd_pretrain_model}")
 
-    columbia_start_time = time.time()
     try:
-        subprocess.run(columbia_command, cwd="/asd", shell=True, check=True, capture_output=True, text=True)
+        subprocess.run(columbia_command, cwd=asd_root, shell=True, check=True, capture_output=True, text=True)
     except subprocess.CalledProcessError as e:
         print("[ERROR] Columbia_test.py failed")
         if e.stdout:
@@ -280,9 +1557,6 @@ def process_clip(base_dir: str, original_video_path: str, s3_key: str, start_tim
         if e.stderr:
             print("[STDERR]", e.stderr)
         raise
-    columbia_end_time = time.time()
-    print(
-        f"Columbia script completed in {columbia_end_time - columbia_start_time:.2f} seconds")
 
     tracks_path = clip_dir / "pywork" / "tracks.pckl"
     scores_path = clip_dir / "pywork" / "scores.pckl"
@@ -294,25 +1568,692 @@ def process_clip(base_dir: str, original_video_path: str, s3_key: str, start_tim
 
     with open(scores_path, "rb") as f:
         scores = pickle.load(f)
+    return tracks, scores
+
+
+class _PreloadedModel:
+    """Stands in for a freshly constructed model inside Columbia_test.py's stages."""
+
+    def __init__(self, model):
+        self._model = model
+
+    def loadParameters(self, path):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+
+def scale_tracks(tracks, scale_x: float, scale_y: float) -> list:
+    """Copies of ASD tracks with bbox and proc_track x/y/s mapped by the given factors."""
+    scaled = []
+    for track in tracks:
+        proc_track = track["proc_track"]
+        bbox = np.asarray(track["track"]["bbox"], dtype=np.float64) * [scale_x, scale_y, scale_x, scale_y]
+        scaled.append({**track,
+                       "track": {**track["track"], "bbox": bbox},
+                       "proc_track": {**proc_track,
+                                      "x": np.asarray(proc_track["x"], dtype=np.float64) * scale_x,
+                                      "y": np.asarray(proc_track["y"], dtype=np.float64) * scale_y,
+                                      "s": np.asarray(proc_track["s"], dtype=np.float64) * scale_y}})
+    return scaled
+
+
+class ActiveSpeakerEngine:
+    """Columbia_test.py's ASD pipeline run in-process with its models kept loaded.
+
+    The script builds S3FD and the ASD network inside inference_video() and
+    evaluate_network() on every run; here both are constructed once and handed
+    to those stages, and tracks/scores are returned directly instead of going
+    through pywork/*.pckl. The visualisation pass is skipped.
+
+    Clips taller than proxy_height are analysed on a downscaled copy
+    (pyavi/video_proxy.avi). facedetScale is left as is, so face detection,
+    like the transcode, frame extraction and crops, runs on the smaller frames.
+    """
+
+    def __init__(self, root: str = asd_root, pretrain_model: str = asd_pretrain_model,
+                 proxy_height: int = asd_proxy_height):
+        self.root = root
+        self.proxy_height = proxy_height
+        if root not in sys.path:
+            sys.path.insert(0, root)
+
+        # Columbia_test.py parses sys.argv at import time and resolves its input
+        # with glob(videoFolder/videoName.*)[0], so it needs a file to find; the
+        # face detector loads its weights relative to the working directory.
+        placeholder_dir = tempfile.mkdtemp(prefix="asd-engine-")
+        pathlib.Path(placeholder_dir, "engine.mp4").touch()
+        saved_argv, saved_cwd = sys.argv, os.getcwd()
+        sys.argv = ["Columbia_test.py", "--videoName", "engine", "--videoFolder", placeholder_dir,
+                    "--pretrainModel", pretrain_model]
+        os.chdir(root)
+        try:
+            import Columbia_test as columbia
+
+            face_detector = columbia.S3FD(device="cuda")
+            asd_model = columbia.ASD()
+            asd_model.loadParameters(os.path.join(root, pretrain_model))
+            asd_model.eval()
+        finally:
+            sys.argv = saved_argv
+            os.chdir(saved_cwd)
+            shutil.rmtree(placeholder_dir, ignore_errors=True)
+
+        missing = [name for name in ("scene_detect", "inference_video", "track_shot", "crop_video",
+                                     "evaluate_network", "args") if not hasattr(columbia, name)]
+        if missing:
+            raise RuntimeError(f"Columbia_test.py is missing {', '.join(missing)}")
+
+        self.columbia = columbia
+        self.default_args = copy.copy(columbia.args)
+        self.default_args.pretrainModel = os.path.join(root, pretrain_model)
+        columbia.S3FD = lambda *args, **kwargs: face_detector
+        columbia.ASD = lambda *args, **kwargs: _PreloadedModel(asd_model)
+        # One set of weights on the GPU, so GPU stages of concurrent clips take turns
+        self.gpu_lock = threading.Lock()
+
+    def run(self, video_path, work_dir):
+        """Detect faces and score active speakers for one clip.
+
+        Uses work_dir/pyavi/audio.wav if the caller already wrote it. Returns
+        (tracks, scores) in the same layout as tracks.pckl and scores.pckl.
+        """
+        columbia = self.columbia
+        work_dir = pathlib.Path(work_dir)
+        args = copy.copy(self.default_args)
+        args.videoPath = str(video_path)
+        args.savePath = str(work_dir)
+        args.pyaviPath = str(work_dir / "pyavi")
+        args.pyframesPath = str(work_dir / "pyframes")
+        args.pyworkPath = str(work_dir / "pywork")
+        args.pycropPath = str(work_dir / "pycrop")
+        for path in (args.pyaviPath, args.pyframesPath, args.pyworkPath, args.pycropPath):
+            os.makedirs(path, exist_ok=True)
+
+        args.videoFilePath = os.path.join(args.pyaviPath, "video.avi")
+        source_info = probe_video(video_path) if self.proxy_height else None
+        use_proxy = source_info is not None and source_info["height"] > self.proxy_height
+        if use_proxy:
+            # Not named video.avi, so the render reads the full-resolution cut instead
+            args.videoFilePath = os.path.join(args.pyaviPath, "video_proxy.avi")
+        scale_filter = f"-vf scale=-2:{self.proxy_height} " if use_proxy else ""
+        subprocess.run(f"ffmpeg -y -i {args.videoPath} {scale_filter}-qscale:v 2 -threads {args.nDataLoaderThread} "
+                       f"-async 1 -r 25 {args.videoFilePath} -loglevel panic",
+                       shell=True, check=True)
+
+        args.audioFilePath = os.path.join(args.pyaviPath, "audio.wav")
+        if not os.path.exists(args.audioFilePath):
+            subprocess.run(f"ffmpeg -y -i {args.videoFilePath} -qscale:a 0 -ac 1 -vn -threads {args.nDataLoaderThread} "
+                           f"-ar 16000 {args.audioFilePath} -loglevel panic",
+                           shell=True, check=True)
+
+        subprocess.run(f"ffmpeg -y -i {args.videoFilePath} -qscale:v 2 -threads {args.nDataLoaderThread} "
+                       f"-f image2 {os.path.join(args.pyframesPath, '%06d.jpg')} -loglevel panic",
+                       shell=True, check=True)
+
+        scene = columbia.scene_detect(args)
+        with self.gpu_lock:
+            faces = columbia.inference_video(args)
+
+        all_tracks = []
+        for shot in scene:
+            if shot[1].frame_num - shot[0].frame_num >= args.minTrack:
+                all_tracks.extend(columbia.track_shot(args, faces[shot[0].frame_num:shot[1].frame_num]))
+
+        tracks = [columbia.crop_video(args, track, os.path.join(args.pycropPath, "%05d" % ii))
+                  for ii, track in enumerate(all_tracks)]
+
+        files = sorted(glob.glob(f"{args.pycropPath}/*.avi"))
+        with self.gpu_lock:
+            scores = columbia.evaluate_network(files, args)
+
+        if use_proxy:
+            proxy_info = probe_video(args.videoFilePath)
+            tracks = scale_tracks(tracks, source_info["width"] / proxy_info["width"],
+                                  source_info["height"] / proxy_info["height"])
+        return tracks, scores
+
+
+def prepare_clip(base_dir: str, original_video_path: str, s3_key: str, start_time: float, end_time: float, clip_index: int,
+                 source_audio: SourceAudio | None = None, keyframe_index: KeyframeIndex | None = None,
+                 asd_engine: ActiveSpeakerEngine | None = None, tracer: StageTracer | None = None,
+                 checkpoint: RunCheckpoint | None = None) -> dict:
+    """Cut and ASD stages of one clip, the GPU half of process_clip.
+
+    Returns the spec render_clip works from: paths, output key and tracks/scores.
+    With a checkpoint, ASD results from an earlier attempt are reused. The cut
+    stays here with ASD: it reads the source, which only this container has
+    on disk, and ASD reads the cut (mostly a stream copy at keyframe starts).
+    """
+    tracer = tracer or StageTracer()
+    clip_name = f"clip_{clip_index}"
+    s3_key_dir = os.path.dirname(s3_key)
+    output_s3_key = f"{s3_key_dir}/{clip_name}.mp4"
+    print(f"Output S3 key: {output_s3_key}")
+
+    clip_dir = base_dir / clip_name
+    clip_dir.mkdir(parents=True, exist_ok=True)
+
+    clip_segment_path = clip_dir / f"{clip_name}_segment.mp4"
+
+    (clip_dir / "pywork").mkdir(exist_ok=True)
+    pyframes_path = clip_dir / "pyframes"
+    pyavi_path = clip_dir / "pyavi"
+    audio_path = clip_dir / "pyavi" / "audio.wav"
+
+    pyframes_path.mkdir(exist_ok=True)
+    pyavi_path.mkdir(exist_ok=True)
+
+    with tracer.span("cut", clip_index) as span:
+        span["mode"] = cut_segment(original_video_path, start_time, end_time, clip_segment_path,
+                                   keyframe_index=keyframe_index)
+
+    checkpointed_asd = checkpoint.clip_asd(clip_index, start_time, end_time) if checkpoint else None
+    if checkpointed_asd is not None:
+        tracks, scores = checkpointed_asd
+        with tracer.span("audio_slice" if source_audio is not None else "audio_extract", clip_index,
+                         checkpointed_asd=True):
+            if source_audio is not None:
+                source_audio.write_wav(start_time, end_time, audio_path)
+            else:
+                extract_audio(clip_segment_path, audio_path)
+    elif asd_engine is not None:
+        if source_audio is not None:
+            with tracer.span("audio_slice", clip_index):
+                source_audio.write_wav(start_time, end_time, audio_path)
+        try:
+            with tracer.span("asd", clip_index, mode="in_process", proxy_height=asd_engine.proxy_height):
+                tracks, scores = asd_engine.run(clip_segment_path, clip_dir)
+        except Exception as e:
+            print(f"[WARN] In-process ASD failed for clip {clip_index}, running Columbia_test.py:", repr(e))
+            # The subprocess path below (and the render source choice) treats this clip as engine-less
+            asd_engine = None
+            (pyavi_path / "video_proxy.avi").unlink(missing_ok=True)
+
+    if checkpointed_asd is None and asd_engine is None:
+        if source_audio is None:
+            with tracer.span("audio_extract", clip_index):
+                extract_audio(clip_segment_path, audio_path)
+
+        shutil.copy(clip_segment_path, base_dir / f"{clip_name}.mp4")
+        with tracer.span("asd", clip_index, mode="subprocess"):
+            tracks, scores = run_columbia_script(base_dir, clip_name)
+
+        if source_audio is not None:
+            # Columbia_test.py recreates clip_dir, so the mux audio is cut after it
+            with tracer.span("audio_slice", clip_index):
+                source_audio.write_wav(start_time, end_time, audio_path)
+
+    if checkpoint is not None and checkpointed_asd is None:
+        checkpoint.save_clip_asd(clip_index, start_time, end_time, tracks, scores)
+
+    render_video_path = None
+    if checkpointed_asd is not None:
+        # No ASD transcode this time; the cut is read at 25 fps like video.avi
+        render_video_path = clip_segment_path
+    elif frame_source == "stream" or (pyavi_path / "video_proxy.avi").exists():
+        # The ASD stage leaves its 25 fps transcode in pyavi/video.avi;
+        # pyframes/ was only needed by face detection. A proxy-resolution
+        # ASD run leaves neither at source resolution, so the cut is read.
+        asd_video_path = pyavi_path / "video.avi"
+        if asd_video_path.exists():
+            render_video_path = asd_video_path
+        elif asd_engine is not None:
+            render_video_path = clip_segment_path
+        else:
+            render_video_path = base_dir / f"{clip_name}.mp4"
+        shutil.rmtree(pyframes_path, ignore_errors=True)
+
+    return {"clip_index": clip_index, "clip_name": clip_name, "output_s3_key": output_s3_key,
+            "start_time": start_time, "end_time": end_time,
+            "pyframes_path": pyframes_path, "pyavi_path": pyavi_path, "audio_path": audio_path,
+            "render_video_path": render_video_path, "tracks": tracks, "scores": scores}
+
+
+def render_clip(spec: dict, subtitle_ass: str, tracer: StageTracer | None = None,
+                transfer_manager: S3TransferManager | None = None):
+    """Render, subtitle and upload stages of one clip, the CPU half of process_clip.
+
+    Returns the output key, or a Future for it when transfer_manager uploads in the background.
+    """
+    tracer = tracer or StageTracer()
+    clip_index = spec["clip_index"]
+    output_s3_key = spec["output_s3_key"]
+    pyavi_path = pathlib.Path(spec["pyavi_path"])
+    vertical_mp4_path = pyavi_path / "video_out_vertical.mp4"
+    subtitle_output_path = pyavi_path / "video_with_subtitles.mp4"
+
+    single_pass = render_mode == "single_pass"
+    subtitle_path = subtitle_engine.write_temp(subtitle_ass, spec["clip_name"]) if single_pass else None
+    try:
+        with tracer.span("render", clip_index, mode=render_mode):
+            create_vertical_video(
+                spec["tracks"], spec["scores"], spec["pyframes_path"], pyavi_path, spec["audio_path"],
+                subtitle_output_path if single_pass else vertical_mp4_path,
+                video_path=spec["render_video_path"], single_pass=single_pass, subtitle_path=subtitle_path
+            )
+    finally:
+        if subtitle_path is not None:
+            subtitle_path.unlink(missing_ok=True)
+
+    if not single_pass:
+        with tracer.span("burn_subtitles", clip_index):
+            create_subtitles_with_ffmpeg(None, spec["start_time"], spec["end_time"],
+                                         vertical_mp4_path, subtitle_output_path, max_words=5,
+                                         ass_text=subtitle_ass)
+
+    if transfer_manager is None:
+        with tracer.span("upload", clip_index) as span:
+            span["bytes"] = os.path.getsize(subtitle_output_path)
+            s3_client = make_s3_client()
+            s3_client.upload_file(
+                subtitle_output_path, output_bucket, output_s3_key)
+        return output_s3_key
+
+    def upload():
+        with tracer.span("upload", clip_index) as span:
+            span["bytes"] = os.path.getsize(subtitle_output_path)
+            span["result"] = transfer_manager.upload(subtitle_output_path, output_bucket, output_s3_key)
+        return output_s3_key
 
-    cvv_start_time = time.time()
-    create_vertical_video(
-        tracks, scores, pyframes_path, pyavi_path, audio_path, vertical_mp4_path
-    )
-    cvv_end_time = time.time()
-    print(
-        f"Clip {clip_index} vertical video creation time: {cvv_end_time - cvv_start_time:.2f} seconds")
+    # Hand the upload to the shared workers so this thread can start the next clip
+    return transfer_manager.submit(upload)
 
-    create_subtitles_with_ffmpeg(transcript_segments, start_time,
-                                 end_time, vertical_mp4_path, subtitle_output_path, max_words=5)
 
-    s3_client = boto3.client("s3")
-    s3_client.upload_file(
-        subtitle_output_path, "ai-podcast-clipper", output_s3_key)
-    return output_s3_key
+artifacts_commit_lock = threading.Lock()
 
 
-@app.cls(gpu="L40S", timeout=900 , retries=0 ,scaledown_window=20 , secrets=[modal.Secret.from_name("ai-podcast-clipper-secret")], volumes={mount_path:volume})
+def commit_artifacts():
+    if stage_split != "modal":
+        return
+    try:
+        with artifacts_commit_lock:
+            artifacts_volume.commit()
+    except Exception as e:
+        print("[WARN] Could not commit artifacts volume:", repr(e))
+
+
+def export_clip_artifacts(spec: dict, subtitle_ass: str, run_id: str) -> str:
+    """Copy what render_clip needs for one clip into artifacts_dir; returns its artifact key.
+
+    Layout: manifest.json, asd.pckl (tracks, scores), subtitles.ass, audio.wav
+    and either the render source video or the pyframes/ JPEGs.
+    """
+    artifact_key = f"{run_id}/{spec['clip_name']}"
+    artifact_path = artifacts_dir / artifact_key
+    shutil.rmtree(artifact_path, ignore_errors=True)
+    artifact_path.mkdir(parents=True)
+
+    render_video = None
+    if spec["render_video_path"] is not None:
+        render_video = "source" + pathlib.Path(spec["render_video_path"]).suffix
+        shutil.copy(spec["render_video_path"], artifact_path / render_video)
+    else:
+        shutil.copytree(spec["pyframes_path"], artifact_path / "pyframes")
+    shutil.copy(spec["audio_path"], artifact_path / "audio.wav")
+    with open(artifact_path / "asd.pckl", "wb") as f:
+        pickle.dump((spec["tracks"], spec["scores"]), f)
+    (artifact_path / "subtitles.ass").write_text(subtitle_ass, encoding="utf-8")
+
+    manifest = {key: spec[key] for key in ("clip_index", "clip_name", "output_s3_key", "start_time", "end_time")}
+    manifest["render_video"] = render_video
+    (artifact_path / "manifest.json").write_text(json.dumps(manifest))
+    commit_artifacts()
+    return artifact_key
+
+
+def render_clip_artifacts(artifact_key: str, transfer_manager: S3TransferManager | None = None,
+                          tracer: StageTracer | None = None) -> str:
+    """Run render_clip on exported artifacts and wait for the upload.
+
+    The artifact dir is removed afterwards, whether or not the render worked.
+    """
+    artifact_path = artifacts_dir / artifact_key
+    manifest = json.loads((artifact_path / "manifest.json").read_text())
+    with open(artifact_path / "asd.pckl", "rb") as f:
+        tracks, scores = pickle.load(f)
+    subtitle_ass = (artifact_path / "subtitles.ass").read_text(encoding="utf-8")
+
+    work_dir = pathlib.Path(tempfile.mkdtemp(prefix=f"{manifest['clip_name']}-"))
+    (work_dir / "pyavi").mkdir()
+    spec = {**manifest, "pyframes_path": artifact_path / "pyframes", "pyavi_path": work_dir / "pyavi",
+            "audio_path": artifact_path / "audio.wav", "tracks": tracks, "scores": scores,
+            "render_video_path": artifact_path / manifest["render_video"] if manifest["render_video"] else None}
+    try:
+        result = render_clip(spec, subtitle_ass, tracer=tracer, transfer_manager=transfer_manager)
+        if isinstance(result, concurrent.futures.Future):
+            result = result.result()
+        return result
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        shutil.rmtree(artifact_path, ignore_errors=True)
+        commit_artifacts()
+
+
+# Threads that wait on ClipRenderer calls, so the clip pool can start the next cut/ASD
+remote_render_pool = concurrent.futures.ThreadPoolExecutor(max_workers=render_worker_max_containers,
+                                                           thread_name_prefix="remote-render")
+
+
+def process_clip(base_dir: str, original_video_path: str, s3_key: str, start_time: float, end_time: float, clip_index: int, transcript: Transcript,
+                 source_audio: SourceAudio | None = None, keyframe_index: KeyframeIndex | None = None,
+                 asd_engine: ActiveSpeakerEngine | None = None, tracer: StageTracer | None = None,
+                 transfer_manager: S3TransferManager | None = None, subtitle_ass: str | None = None,
+                 checkpoint: RunCheckpoint | None = None, render_handoff=None):
+    # Returns the output key, or a Future for it when the upload or render runs elsewhere.
+    # Returns None when render_handoff is set: a ClipRenderer then records the clip.
+    tracer = tracer or StageTracer()
+    spec = prepare_clip(base_dir, original_video_path, s3_key, start_time, end_time, clip_index,
+                        source_audio=source_audio, keyframe_index=keyframe_index,
+                        asd_engine=asd_engine, tracer=tracer, checkpoint=checkpoint)
+
+    if subtitle_ass is None:
+        with tracer.span("subtitles", clip_index):
+            subtitle_ass = subtitle_engine.render(transcript, start_time, end_time, max_words=5)
+
+    if stage_split == "off":
+        return render_clip(spec, subtitle_ass, tracer=tracer, transfer_manager=transfer_manager)
+
+    with tracer.span("export_artifacts", clip_index):
+        artifact_key = export_clip_artifacts(spec, subtitle_ass, tracer.run_id or uuid.uuid4().hex)
+
+    if stage_split == "local":
+        return render_clip_artifacts(artifact_key, transfer_manager=transfer_manager, tracer=tracer)
+
+    if render_handoff is not None:
+        ClipRenderer().render.spawn(artifact_key, tracer.run_id,
+                                    {"index": clip_index, "start": start_time, "end": end_time},
+                                    render_handoff.job_id)
+        return None
+
+    def render_remote():
+        with tracer.span("remote_render", clip_index):
+            result = ClipRenderer().render.remote(artifact_key, tracer.run_id)
+        tracer.extend(result["spans"], worker="cpu")
+        return result["s3_key"]
+
+    return remote_render_pool.submit(render_remote)
+
+
+def _run_clip_job(base_dir, original_video_path, s3_key, index: int, moment, transcript: Transcript,
+                  source_audio: SourceAudio | None = None, keyframe_index: KeyframeIndex | None = None,
+                  asd_engine: ActiveSpeakerEngine | None = None, tracer: StageTracer | None = None,
+                  transfer_manager: S3TransferManager | None = None, subtitle_ass: str | None = None,
+                  checkpoint: RunCheckpoint | None = None, render_handoff=None):
+    result = {"index": index, "start": None, "end": None}
+    if not isinstance(moment, dict) or "start" not in moment or "end" not in moment:
+        result.update(status="skipped", error="Moment is missing start/end")
+        return result, None
+
+    result.update(start=moment["start"], end=moment["end"])
+    done_key = checkpoint.clip_output(index, moment["start"], moment["end"]) if checkpoint else None
+    if done_key is not None:
+        print(f"Clip {index} already uploaded by an earlier attempt")
+        result.update(status="ok", s3_key=done_key, resumed=True)
+        return result, None
+    print("Processing clip" + str(index) + " from " +
+          str(moment["start"]) + " to " + str(moment["end"]))
+    try:
+        out_key = process_clip(base_dir, original_video_path, s3_key,
+                               moment["start"], moment["end"], index, transcript,
+                               source_audio=source_audio, keyframe_index=keyframe_index,
+                               asd_engine=asd_engine, tracer=tracer, transfer_manager=transfer_manager,
+                               subtitle_ass=subtitle_ass, checkpoint=checkpoint, render_handoff=render_handoff)
+    except FileNotFoundError as e:
+        print(f"[ERROR] Clip {index} failed:", repr(e))
+        result.update(status="error",
+                      error=f"ASD outputs missing (tracks/scores). Ensure weights and dependencies are present: {e}")
+    except Exception as e:
+        print(f"[ERROR] Clip {index} failed:", repr(e))
+        result.update(status="error", error=str(e))
+    else:
+        if isinstance(out_key, concurrent.futures.Future):
+            return result, out_key
+        if out_key is None:
+            result.update(status="rendering")
+        else:
+            result.update(status="ok", s3_key=out_key)
+    return result, None
+
+
+def _settle_clip_job(clip_future):
+    result, upload_future = clip_future.result()
+    if upload_future is not None:
+        try:
+            result.update(status="ok", s3_key=upload_future.result())
+        except Exception as e:
+            print(f"[ERROR] Clip {result['index']} upload failed:", repr(e))
+            result.update(status="error", error=f"Upload failed: {e}")
+    return result
+
+
+def process_clips(base_dir, original_video_path, s3_key, clip_moments: list, transcript: Transcript, max_workers: int | None = None,
+                  source_audio: SourceAudio | None = None, keyframe_index: KeyframeIndex | None = None,
+                  asd_engine: ActiveSpeakerEngine | None = None, tracer: StageTracer | None = None,
+                  on_clip_done=None, transfer_manager: S3TransferManager | None = None,
+                  checkpoint: RunCheckpoint | None = None, render_handoff=None):
+    """Run process_clip for every moment on a bounded thread pool.
+
+    Results come back in moment order; a failing clip is reported in its own
+    entry instead of aborting the clips that succeeded. With a transfer_manager,
+    uploads run on its workers while the pool moves on to the next clip.
+    Subtitles for every moment are rendered up front in one batch. With a
+    checkpoint, clips uploaded by an earlier attempt are skipped. With a
+    render_handoff, clips come back as "rendering" once ASD is done.
+    """
+    if not clip_moments:
+        return []
+
+    tracer = tracer or StageTracer()
+    with tracer.span("subtitles", clips=len(clip_moments)):
+        subtitle_docs = subtitle_engine.render_many(transcript, clip_moments, max_words=5)
+
+    limit = max_workers or default_clip_concurrency
+    limit = max(1, min(limit, len(clip_moments)))
+    print(f"Processing {len(clip_moments)} clips with concurrency {limit}")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=limit, thread_name_prefix="clip") as executor:
+        futures = [executor.submit(_run_clip_job, base_dir, original_video_path, s3_key,
+                                   index, moment, transcript, source_audio, keyframe_index, asd_engine,
+                                   tracer, transfer_manager, subtitle_docs[index], checkpoint, render_handoff)
+                   for index, moment in enumerate(clip_moments)]
+
+        def settle(future):
+            result = _settle_clip_job(future)
+            if checkpoint is not None and result["status"] == "ok" and not result.get("resumed"):
+                checkpoint.save_clip_output(result["index"], result["start"], result["end"], result["s3_key"])
+            return result
+
+        settled = {}
+        if on_clip_done is not None:
+            for future in concurrent.futures.as_completed(futures):
+                settled[future] = settle(future)
+                on_clip_done(settled[future])
+        return [settled[future] if future in settled else settle(future) for future in futures]
+
+
+def summarize_clips(clip_moments: list, clip_results: list) -> dict:
+    """render_moments' result for clip_results.
+
+    status is "rendering" while ClipRenderer still has clips, and "failed"
+    when every clip failed.
+    """
+    output_keys = [clip["s3_key"] for clip in clip_results if clip["status"] == "ok"]
+    failed = [clip for clip in clip_results if clip["status"] == "error"]
+    if any(clip["status"] == "rendering" for clip in clip_results):
+        status = "rendering"
+    elif failed and not output_keys:
+        status = "failed"
+    else:
+        status = "partial" if failed else "ok"
+    return {"status": status, "moments": clip_moments, "outputs": output_keys, "clips": clip_results}
+
+
+def check_auth_token(token: HTTPAuthorizationCredentials):
+    if token.credentials != os.environ.get("AUTH_TOKEN", ""):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect Bearer Token",
+                             headers={"WWW-Authenticate": "Bearer"})
+
+
+def pipeline_settings() -> dict:
+    """Deployment settings that change what a run produces for the same input."""
+    return {
+        "max_clips": max_clips_per_video,
+        "subtitle_max_words": 5,
+        "render_mode": render_mode,
+        "background_blur_scale": background_blur_scale,
+        "whisperx_model": whisperx_model_name,
+        "asd_proxy_height": asd_proxy_height,
+        "transcribe_mode": transcribe_mode,
+        "gemini_model": os.environ.get("GEMINI_MODEL", "gemini-2.5-flash-preview-04-17"),
+        "moment_engine": moment_engine,
+    }
+
+
+def source_etag_for(s3_client, s3_key: str) -> str:
+    return s3_client.head_object(Bucket=input_bucket, Key=s3_key).get("ETag", "").strip('"')
+
+
+def job_id_for(s3_key: str, source_etag: str = "") -> str:
+    # A new upload under the same key has a new ETag, so it gets a new job
+    identity = {"s3_key": s3_key, "source_etag": source_etag, "settings": pipeline_settings()}
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()[:32]
+
+
+class JobReporter:
+    """Writes a job's progress (status, stage spans, finished clips) to the jobs Dict."""
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.lock = threading.Lock()
+
+    def update(self, **fields):
+        with self.lock:
+            record = jobs.get(self.job_id) or {"job_id": self.job_id}
+            record.update(fields, updated_at=time.time())
+            jobs[self.job_id] = record
+            return record
+
+    def _append(self, field: str, item: dict):
+        with self.lock:
+            record = jobs.get(self.job_id) or {"job_id": self.job_id}
+            record[field] = record.get(field, []) + [item]
+            record["updated_at"] = time.time()
+            jobs[self.job_id] = record
+
+    def on_span(self, span: dict):
+        self._append("stages", {key: span.get(key) for key in
+                                ("stage", "clip_index", "status", "wall_s", "cpu_s", "error")})
+
+    def on_clip_done(self, clip: dict):
+        self._append("clips", clip)
+
+
+def send_webhook(url: str, payload: dict, attempts: int = 3) -> str:
+    body = json.dumps(payload, default=str).encode()
+    for attempt in range(attempts):
+        try:
+            webhook_request = urllib.request.Request(url, data=body, method="POST",
+                                                     headers={"Content-Type": "application/json"})
+            with urllib.request.urlopen(webhook_request, timeout=10) as response:
+                return f"delivered ({response.status})"
+        except Exception as e:
+            print(f"[WARN] Webhook attempt {attempt + 1} to {url} failed:", repr(e))
+            time.sleep(2 ** attempt)
+    return "failed"
+
+
+class RenderHandoff:
+    """Clips of a run_job whose render and upload went to ClipRenderer.
+
+    The GPU side seals the run's result, clips still "rendering", and returns.
+    Each render worker records its clip under the run; whichever write
+    completes the set finishes the job: the job record, the checkpoint and
+    the webhook. The entries live in the jobs Dict until then.
+    """
+
+    def __init__(self, run_id: str, job_id: str, store=jobs):
+        self.run_id = run_id
+        self.job_id = job_id
+        self.store = store
+
+    def _clip_key(self, clip_index: int) -> str:
+        return f"{self.run_id}:render:{clip_index}"
+
+    def record_clip(self, clip: dict):
+        """Render worker side: store one finished (or failed) clip."""
+        self.store[self._clip_key(clip["index"])] = clip
+        return self.try_finish()
+
+    def seal(self, result: dict, webhook_url: str | None = None, checkpoint: bool = False):
+        """GPU side: store the run's result once every clip is through ASD."""
+        self.store[f"{self.run_id}:render-handoff"] = {"result": result, "webhook_url": webhook_url,
+                                                       "checkpoint": checkpoint}
+        return self.try_finish()
+
+    def try_finish(self):
+        """Finish the job if the run is sealed and every clip is recorded; returns its record."""
+        sealed = self.store.get(f"{self.run_id}:render-handoff")
+        if sealed is None:
+            return None
+        clips, rendered = [], []
+        for clip in sealed["result"]["clips"]:
+            if clip["status"] == "rendering":
+                clip = self.store.get(self._clip_key(clip["index"]))
+                if clip is None:
+                    return None
+                rendered.append(clip)
+            clips.append(clip)
+        # The last two writers can both see the full set; only one finishes
+        if not self.store.put(f"{self.run_id}:render-finished", True, skip_if_exists=True):
+            return None
+        return self.finish(sealed, clips, rendered)
+
+    def finish(self, sealed: dict, clips: list, rendered: list) -> dict:
+        result = summarize_clips(sealed["result"]["moments"], clips)
+        if sealed["checkpoint"]:
+            checkpoint = RunCheckpoint.claim(self.job_id)
+            if checkpoint is not None:
+                try:
+                    for clip in rendered:
+                        if clip["status"] == "ok":
+                            checkpoint.save_clip_output(clip["index"], clip["start"], clip["end"], clip["s3_key"])
+                    if result["status"] == "ok":
+                        checkpoint.clear()
+                finally:
+                    checkpoint.release()
+
+        reporter = JobReporter(self.job_id)
+        if result["status"] == "failed":
+            failed = [clip for clip in clips if clip["status"] == "error"]
+            record = reporter.update(status="failed", clips=clips, finished_at=time.time(),
+                                     error={"status_code": 500, "detail": f"All clips failed: {failed[0]['error']}"})
+        else:
+            record = reporter.update(status="succeeded", clips=clips, result=result, finished_at=time.time())
+        if sealed["webhook_url"]:
+            record = reporter.update(webhook_status=send_webhook(sealed["webhook_url"], record))
+
+        try:
+            for key in [self._clip_key(clip["index"]) for clip in rendered] + [f"{self.run_id}:render-handoff"]:
+                self.store.pop(key)
+        except Exception as e:
+            print(f"[WARN] Could not remove render handoff of {self.run_id}:", repr(e))
+        return record
+
+
+def parse_key_manifest(body: bytes) -> list:
+    """S3 keys from a batch manifest: a JSON list, {"s3_keys": [...]} or one key per line."""
+    text = body.decode().strip()
+    if text.startswith(("[", "{")):
+        manifest = json.loads(text)
+        keys = manifest.get("s3_keys", []) if isinstance(manifest, dict) else manifest
+    else:
+        keys = text.splitlines()
+    return [key.strip() for key in keys if isinstance(key, str) and key.strip()]
+
+
+@app.cls(gpu="L40S", timeout=pipeline_timeout_s , retries=0 ,scaledown_window=20 , secrets=[modal.Secret.from_name("ai-podcast-clipper-secret")], volumes={mount_path:volume, artifacts_mount:artifacts_volume})
 
 class AiPodcastClipper:
     @modal.enter()
@@ -320,15 +2261,30 @@ class AiPodcastClipper:
         print("Loading Model")
         
         self.whisperx_model = whisperx.load_model(
-            "large-v2" , device="cuda" , compute_type= "float16"
+            whisperx_model_name , device="cuda" , compute_type= whisperx_compute_type
         )
         
         self.alignment_model, self.metadata = whisperx.load_align_model(
-            language_code= "en",
+            language_code= alignment_language,
             device= "cuda"
         )
 
         print("Transcripto Model Loaded")
+
+        # Probe once at container start rather than on the first clip
+        print(f"Using video encoder {video_encoder.name}")
+
+        self.s3 = S3TransferManager()
+
+        self.asd_engine = None
+        if asd_mode == "in_process":
+            print("Loading ASD models........")
+            try:
+                self.asd_engine = ActiveSpeakerEngine()
+                print("ASD models loaded")
+            except Exception as e:
+                # Every clip then pays the subprocess model load; make that visible in the startup log
+                print("[ERROR] Could not load in-process ASD engine, every clip will run Columbia_test.py:", repr(e))
           
         print ("Creating GEMINI Client........")
         self.gemini_client = genai.Client(api_key=os.environ["GEMINI_API_KEY"])
@@ -347,17 +2303,13 @@ class AiPodcastClipper:
             print(f"Using Gemini model '{self.gemini_model_name}'")
         print("Created Gemini Client............")
 
-    def transcribe_video(self, base_dir: str, video_path: str) -> str:
-        audio_path = base_dir / "audio.wav"
-        extract_cmd = f"ffmpeg -i {video_path} -vn -acodec pcm_s16le -ar 16000 -ac 1 {audio_path}"
-        subprocess.run(extract_cmd, shell=True,
-                       check=True, capture_output=True)
+    def transcribe_video(self, source_audio: SourceAudio) -> Transcript:
+        if transcribe_mode == "vad_chunked":
+            return Transcript.from_segments(self.iter_transcript_words(source_audio))
 
         print("Starting transcription with WhisperX...")
-        start_time = time.time()
-
-        audio = whisperx.load_audio(str(audio_path))
-        result = self.whisperx_model.transcribe(audio, batch_size=16)
+        audio = source_audio.as_float32()
+        result = self.whisperx_model.transcribe(audio, batch_size=whisperx_batch_size)
 
         result = whisperx.align(
             result["segments"],
@@ -368,25 +2320,44 @@ class AiPodcastClipper:
             return_char_alignments=False
         )
 
-        duration = time.time() - start_time
-        print("Transcription and alignment took " + str(duration) + " seconds")
-
-        segments = []
-
-
-        for word_segment in result["word_segments"]:
-                segments.append({
-                    "start": word_segment["start"],
-                    "end": word_segment["end"],
+        return Transcript.from_segments(result["word_segments"])
+
+    def iter_transcript_words(self, source_audio: SourceAudio, chunk_s: float = transcribe_chunk_s):
+        """Yield word segments on the source timeline, one VAD chunk at a time.
+
+        Only speech is decoded, and no more than chunk_s seconds of audio is in
+        memory as float32 at once, so peak memory does not grow with episode length.
+        """
+        energy_db = frame_energy_db(source_audio)
+        chunks = plan_transcription_chunks(energy_db, speech_regions(energy_db), max_chunk_s=chunk_s)
+        speech_s = sum(end - start for start, end in chunks)
+        print(f"Starting chunked transcription with WhisperX: {len(chunks)} chunks, "
+              f"{speech_s:.0f}s of {source_audio.duration:.0f}s audio")
+        if source_audio.duration and speech_s < 0.75 * source_audio.duration:
+            print(f"[WARN] The energy VAD skips {source_audio.duration - speech_s:.0f}s of audio; quiet "
+                  f"speech in it will be missing from the transcript (TRANSCRIBE_MODE=full decodes everything)")
+        for start, end in chunks:
+            audio = source_audio.slice(start, end).astype(np.float32) / 32768.0
+            # Fix the language so short chunks don't each re-detect it
+            result = self.whisperx_model.transcribe(audio, batch_size=whisperx_batch_size, language=alignment_language)
+            if not result["segments"]:
+                continue
+            result = whisperx.align(result["segments"], self.alignment_model, self.metadata, audio,
+                                    device="cuda", return_char_alignments=False)
+            for word_segment in result["word_segments"]:
+                # Alignment leaves some tokens (e.g. bare numbers) without timings
+                if "start" not in word_segment or "end" not in word_segment:
+                    continue
+                yield {
+                    "start": round(word_segment["start"] + start, 3),
+                    "end": round(word_segment["end"] + start, 3),
                     "word": word_segment["word"],
-                })
-
-        return json.dumps(segments)
+                }
 
 
-    def identify_moments(self, transcript: dict):
+    def identify_moments(self, transcript: Transcript):
         response = self.gemini_client.models.generate_content(model=self.gemini_model_name, contents="""
-    This is a podcast video transcript consisting of word, along with each words's start and end time. I am looking to create clips between a minimum of 30 and maximum of 60 seconds long. The clip should never exceed 60 seconds.
+    This is a podcast video transcript. Each line is one sentence in the form start|end|text, with start and end in seconds. I am looking to create clips between a minimum of 30 and maximum of 60 seconds long. The clip should never exceed 60 seconds.
 
     Your task is to find and extract stories, or question and their corresponding answers from the transcript.
     Each clip should begin with the question and conclude with the answer.
@@ -395,7 +2366,7 @@ class AiPodcastClipper:
     Please adhere to the following rules:
     - Ensure that clips do not overlap with one another.
     - Start and end timestamps of the clips should align perfectly with the sentence boundaries in the transcript.
-    - Only use the start and end timestamps provided in the input. modifying timestamps is not allowed.
+    - Only use the start and end timestamps provided in the input. modifying timestamps is not allowed. A clip starts at a line's start and ends at a (possibly later) line's end.
     - Format the output as a list of JSON objects, each representing a clip with 'start' and 'end' timestamps: [{"start": seconds, "end": seconds}, ...clip2, clip3]. The output should always be readable by the python json.loads function.
     - Aim to generate longer clips between 40-60 seconds, and ensure to include as much content from the context as viable.
 
@@ -405,86 +2376,486 @@ class AiPodcastClipper:
 
     If there are no valid clips to extract, the output should be an empty list [], in JSON format. Also readable by json.loads() in Python.
 
-    The transcript is as follows:\n\n""" + str(transcript))
+    The transcript is as follows:\n\n""" + serialize_transcript(transcript))
         print(f"Identified moments response: ${response.text}")
         return response.text
 
-        
-    @modal.fastapi_endpoint(method="POST")
-    def process_video(self, request: ProcessVideoRequest, token: HTTPAuthorizationCredentials = Depends(auth_scheme)):
-        s3_key = request.s3_key
-
-        if token.credentials != os.environ.get("AUTH_TOKEN", ""):
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect Bearer Token",
-                                 headers={"WWW-Authenticate": "Bearer"})
-
-        run_id = str(uuid.uuid4())
+    def select_moments(self, transcript: Transcript, source_audio: SourceAudio, tracer: StageTracer) -> list:
+        """Clip moments from the configured engine, falling back to the heuristic one if Gemini fails."""
+        if moment_engine == "heuristic":
+            with tracer.span("identify_moments", engine="heuristic"):
+                return heuristic_moment_engine.select(transcript, source_audio)
+
+        cache_key = moment_cache_key(transcript, self.gemini_model_name) if moment_cache_enabled else None
+        if cache_key is not None:
+            with tracer.span("moment_cache_lookup") as span:
+                cached = moment_cache.get(cache_key)
+                span["hit"] = cached is not None
+            moment_cache.publish()
+            if cached is not None:
+                print(f"Moment cache hit ({moment_cache.stats()})")
+                return cached
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        try:
+            with tracer.span("identify_moments", engine="gemini", model=self.gemini_model_name):
+                try:
+                    identified_moments_raw = executor.submit(self.identify_moments, transcript).result(
+                        timeout=gemini_timeout_s)
+                except concurrent.futures.TimeoutError:
+                    raise TimeoutError(f"no response after {gemini_timeout_s:.0f}s")
+                except Exception as e:
+                    raise RuntimeError(f"Gemini call failed: {e}") from e
+                clip_moments = parse_moments_json(identified_moments_raw)
+        except (RuntimeError, TimeoutError, ValueError) as e:
+            if moment_fallback != "heuristic":
+                # Surface LLM errors clearly as a 502 to the client
+                detail = str(e) if not isinstance(e, TimeoutError) else f"Gemini call failed: {e}"
+                raise HTTPException(status_code=502, detail=detail)
+            print("[WARN] Gemini moment selection failed, using the heuristic engine:", repr(e))
+            with tracer.span("identify_moments", engine="heuristic", fallback=True):
+                return heuristic_moment_engine.select(transcript, source_audio)
+        finally:
+            # Don't wait on a timed-out call; it finishes in the background
+            executor.shutdown(wait=False)
+        clip_moments = validate_moments(snap_moments_to_words(clip_moments, transcript))
+        if cache_key is not None:
+            moment_cache.put(cache_key, clip_moments)
+            moment_cache.publish()
+        return clip_moments
+
+    def ingest_video(self, s3_key: str, base_dir: pathlib.Path, tracer: StageTracer) -> dict:
+        """Download s3_key into base_dir and make sure its audio.wav exists."""
+        # Download video file, extracting the audio as it streams in
+        video_path = base_dir / "input.mp4"
+        audio_path = base_dir / "audio.wav"
+        s3_client = self.s3.client
+        try:
+            with tracer.span("download") as span:
+                head = s3_client.head_object(Bucket=input_bucket, Key=s3_key)
+                source_etag = head.get("ETag", "").strip('"')
+                audio_streamed = ingest_source(s3_client, input_bucket, s3_key, video_path, audio_path,
+                                               head["ContentLength"])
+                span["bytes"] = head["ContentLength"]
+                span["audio_streamed"] = audio_streamed
+        except Exception as e:
+            print(f"[ERROR] Failed to download from S3: bucket={input_bucket} key={s3_key}")
+            raise HTTPException(status_code=400, detail=f"Could not download input video from S3: {e}")
+
+        if not audio_streamed:
+            with tracer.span("audio_extract"):
+                extract_audio(video_path, audio_path)
+
+        keyframe_index = None
+        if clip_stream_copy == "auto":
+            def build_keyframe_index():
+                with tracer.span("keyframe_index"):
+                    return KeyframeIndex(video_path)
+
+            # Probed while the GPU transcribes; render_moments waits for it
+            keyframe_index = background_pool.submit(build_keyframe_index)
+        return {"video_path": video_path, "source_etag": source_etag, "source_audio": SourceAudio(audio_path),
+                "keyframe_index": keyframe_index}
+
+    def transcript_for(self, source: dict, s3_key: str, tracer: StageTracer,
+                       checkpoint: RunCheckpoint | None = None) -> Transcript:
+        if checkpoint is not None:
+            checkpoint.bind_source(source["source_etag"])
+            transcript = checkpoint.transcript()
+            if transcript is not None:
+                print(f"Transcript for {s3_key} restored from checkpoint")
+                return transcript
+
+        transcript = None
+        if transcript_cache_enabled:
+            with tracer.span("transcript_cache_lookup") as span:
+                source_etag = source["source_etag"]
+                source_id = f"s3-etag:{source_etag}" if source_etag else f"sha256:{file_sha256(source['video_path'])}"
+                cache_key = transcript_cache_key(source_id)
+                cached = transcript_cache.get(cache_key)
+                span["hit"] = cached is not None
+            if cached is not None:
+                print(f"Transcript cache hit for {s3_key}")
+                transcript = Transcript.from_bytes(cached)
+        if transcript is None:
+            with tracer.span("transcribe") as span:
+                transcript = self.transcribe_video(source["source_audio"])
+                span["words"] = len(transcript)
+            if transcript_cache_enabled:
+                transcript_cache.put(cache_key, transcript.to_bytes())
+        if checkpoint is not None:
+            checkpoint.save_transcript(transcript)
+        return transcript
+
+    def render_moments(self, s3_key: str, base_dir: pathlib.Path, source: dict, transcript: Transcript,
+                       tracer: StageTracer, max_concurrent_clips: int | None = None, on_clip_done=None,
+                       checkpoint: RunCheckpoint | None = None, render_handoff: RenderHandoff | None = None) -> dict:
+        """Pick moments, then cut, render and upload a clip for each."""
+        # 2. Identify Moments for Clips
+        print("Identifying clip moments")
+        clip_moments = checkpoint.moments() if checkpoint is not None else None
+        if clip_moments is None:
+            clip_moments = self.select_moments(transcript, source["source_audio"], tracer)
+            if checkpoint is not None:
+                checkpoint.save_moments(clip_moments)
+        if not clip_moments:
+            print("[WARN] Identified moments is empty or not a list; skipping clip generation")
+            return {"status": "ok", "moments": [], "outputs": []}
+
+        # 3. Process clips
+        video_path = source["video_path"]
+        keyframe_index = None
+        if source.get("keyframe_index") is not None:
+            with tracer.span("keyframe_index_wait"):
+                try:
+                    keyframe_index = source["keyframe_index"].result()
+                except Exception as e:
+                    print("[WARN] Keyframe probe failed; clips will be re-encoded:", repr(e))
+        clip_windows = clip_moments[:max_clips_per_video]
+        if keyframe_index is not None:
+            clip_windows = snap_moments_to_keyframes(clip_windows, transcript, keyframe_index)
+        clip_results = process_clips(base_dir, video_path, s3_key, clip_windows,
+                                     transcript, max_workers=max_concurrent_clips,
+                                     source_audio=source["source_audio"], keyframe_index=keyframe_index,
+                                     asd_engine=self.asd_engine, tracer=tracer,
+                                     on_clip_done=on_clip_done, transfer_manager=self.s3,
+                                     checkpoint=checkpoint, render_handoff=render_handoff)
+        result = summarize_clips(clip_moments, clip_results)
+        if result["status"] == "failed":
+            failed = [clip for clip in clip_results if clip["status"] == "error"]
+            raise HTTPException(status_code=500, detail=f"All clips failed: {failed[0]['error']}")
+        return result
+
+    def run_pipeline(self, run_id: str, s3_key: str, tracer: StageTracer, max_concurrent_clips: int | None = None,
+                     on_clip_done=None, checkpoint: RunCheckpoint | None = None,
+                     render_handoff: RenderHandoff | None = None):
         base_dir = pathlib.Path("/tmp/" + run_id)
         base_dir.mkdir(parents=True, exist_ok=True)
 
-        output_keys = []
         try:
-            # Download video file
-            video_path = base_dir / "input.mp4"
-            s3_client = boto3.client("s3")
-            try:
-                s3_client.download_file("ai-podcast-clipper200", s3_key, str(video_path))
-            except Exception as e:
-                print(f"[ERROR] Failed to download from S3: bucket=ai-podcast-clipper200 key={s3_key}")
-                raise HTTPException(status_code=400, detail=f"Could not download input video from S3: {e}")
-
+            source = self.ingest_video(s3_key, base_dir, tracer)
             # 1. Transcription
-            transcript_segments_json = self.transcribe_video(base_dir, video_path)
-            transcript_segments = json.loads(transcript_segments_json)
-
-            # 2. Identify Moments for Clips
-            print("Identifying clip moments")
-            try:
-                identified_moments_raw = self.identify_moments(transcript_segments)
-            except Exception as e:
-                # Surface LLM errors clearly as a 502 to the client
-                raise HTTPException(status_code=502, detail=f"Gemini call failed: {e}")
-
-            cleaned_json_string = identified_moments_raw.strip()
-            if cleaned_json_string.startswith("```json"):
-                cleaned_json_string = cleaned_json_string[len("```json"):].strip()
-            if cleaned_json_string.endswith("```"):
-                cleaned_json_string = cleaned_json_string[:-len("```")].strip()
-
-            try:
-                clip_moments = json.loads(cleaned_json_string)
-            except Exception as e:
-                print("[ERROR] Failed to parse moments JSON:", cleaned_json_string)
-                raise HTTPException(status_code=502, detail=f"Gemini output could not be parsed as JSON: {e}")
-
-            if not clip_moments or not isinstance(clip_moments, list):
-                print("[WARN] Identified moments is empty or not a list; skipping clip generation")
-                return {"status": "ok", "moments": [], "outputs": []}
-
-            # 3. Process clips
-            for index, moment in enumerate(clip_moments[:5]):
-                if "start" in moment and "end" in moment:
-                    print("Processing clip" + str(index) + " from " +
-                          str(moment["start"]) + " to " + str(moment["end"]))
-                    try:
-                        out_key = process_clip(base_dir, video_path, s3_key,
-                                               moment["start"], moment["end"], index, transcript_segments)
-                        output_keys.append(out_key)
-                    except FileNotFoundError as e:
-                        raise HTTPException(status_code=500, detail=f"ASD outputs missing (tracks/scores). Ensure weights and dependencies are present: {e}")
-            return {"status": "ok", "moments": clip_moments, "outputs": output_keys}
+            transcript = self.transcript_for(source, s3_key, tracer, checkpoint=checkpoint)
+            result = self.render_moments(s3_key, base_dir, source, transcript, tracer,
+                                         max_concurrent_clips=max_concurrent_clips, on_clip_done=on_clip_done,
+                                         checkpoint=checkpoint, render_handoff=render_handoff)
+            if checkpoint is not None and result["status"] == "ok":
+                # Partial runs keep theirs so a retry only redoes the failed clips
+                checkpoint.clear()
+            return result
         except HTTPException:
             raise
         except Exception as e:
             print("[ERROR] Unhandled error in process_video:", repr(e))
             raise HTTPException(status_code=500, detail=str(e))
         finally:
+            if checkpoint is not None:
+                checkpoint.release()
+            tracer.write_jsonl()
             if base_dir.exists():
                 print(f"Cleaning up temp dir after {base_dir}")
                 shutil.rmtree(base_dir, ignore_errors=True)
 
-       
-     
+    @modal.fastapi_endpoint(method="POST")
+    def process_video(self, request: ProcessVideoRequest, token: HTTPAuthorizationCredentials = Depends(auth_scheme)):
+        check_auth_token(token)
+
+        run_id = str(uuid.uuid4())
+        tracer = StageTracer(run_id)
+        checkpoint = None
+        if checkpoints_enabled:
+            try:
+                source_etag = source_etag_for(self.s3.client, request.s3_key)
+            except Exception as e:
+                raise HTTPException(status_code=400, detail=f"Could not download input video from S3: {e}")
+            checkpoint = RunCheckpoint.claim(job_id_for(request.s3_key, source_etag))
+        response = self.run_pipeline(run_id, request.s3_key, tracer,
+                                     max_concurrent_clips=request.max_concurrent_clips, checkpoint=checkpoint)
+        if request.include_timings:
+            response["timings"] = tracer.spans
+        return response
+
+    @modal.method()
+    def run_job(self, job_id: str, attempt: int, request: dict):
+        reporter = JobReporter(job_id)
+        reporter.update(status="running", started_at=time.time())
+        run_id = f"{job_id}-{attempt}"
+        tracer = StageTracer(run_id, on_span=reporter.on_span)
+        try:
+            # Attempts share the job's checkpoint, so a retry picks up where the last one stopped
+            checkpoint = RunCheckpoint.claim(job_id) if checkpoints_enabled else None
+            render_handoff = RenderHandoff(run_id, job_id) if stage_split == "modal" else None
+            result = self.run_pipeline(run_id, request["s3_key"], tracer,
+                                       max_concurrent_clips=request.get("max_concurrent_clips"),
+                                       on_clip_done=reporter.on_clip_done, checkpoint=checkpoint,
+                                       render_handoff=render_handoff)
+            if result["status"] == "rendering":
+                # ClipRenderer finishes the job (and sends the webhook); this container is done
+                reporter.update(status="rendering", result=result)
+                return render_handoff.seal(result, webhook_url=request.get("webhook_url"),
+                                           checkpoint=checkpoint is not None) or jobs.get(job_id)
+            record = reporter.update(status="succeeded", result=result, finished_at=time.time())
+        except HTTPException as e:
+            record = reporter.update(status="failed", error={"status_code": e.status_code, "detail": e.detail},
+                                     finished_at=time.time())
+        except Exception as e:
+            print("[ERROR] Unhandled error in run_job:", repr(e))
+            record = reporter.update(status="failed", error={"status_code": 500, "detail": str(e)},
+                                     finished_at=time.time())
+
+        if request.get("webhook_url"):
+            record = reporter.update(webhook_status=send_webhook(request["webhook_url"], record))
+        return record
+
+    @modal.method()
+    def run_batch(self, batch_id: str, s3_keys: list, request: dict):
+        """Process s3_keys in order on this warm container as a three-stage pipeline.
+
+        While video N is transcribed on the GPU, video N+1 downloads and video
+        N-1 renders. Each video's result is appended to the batch record; when
+        the time budget runs out the remaining keys go to a new run_batch call.
+        The final per-video manifest is written to the output bucket.
+        """
+        started_at = time.time()
+        record_lock = threading.Lock()
+
+        def report(**fields):
+            with record_lock:
+                record = {**(jobs.get(batch_id) or {}), **fields, "updated_at": time.time()}
+                jobs[batch_id] = record
+                return record
+
+        def add_video(entry: dict):
+            with record_lock:
+                record = jobs.get(batch_id) or {}
+                record["videos"] = record.get("videos", []) + [entry]
+                record["updated_at"] = time.time()
+                jobs[batch_id] = record
+
+        def finish(video: dict, result: dict | None = None, error: Exception | None = None):
+            if video["checkpoint"] is not None:
+                video["checkpoint"].release()
+            video["tracer"].write_jsonl()
+            shutil.rmtree(video["base_dir"], ignore_errors=True)
+            entry = {"s3_key": video["s3_key"], "run_id": video["run_id"],
+                     "elapsed_s": round(time.time() - video["started_at"], 3)}
+            if error is None:
+                entry.update(status="succeeded", result=result)
+            else:
+                print(f"[ERROR] Batch video {video['s3_key']} failed:", repr(error))
+                entry.update(status="failed", error={"status_code": getattr(error, "status_code", 500),
+                                                     "detail": getattr(error, "detail", str(error))})
+            add_video(entry)
+            return entry
+
+        def start_download(s3_key: str):
+            run_id = f"{batch_id}-{uuid.uuid4().hex[:8]}"
+            checkpoint = None
+            if checkpoints_enabled:
+                try:
+                    checkpoint = RunCheckpoint.claim(job_id_for(s3_key, source_etag_for(self.s3.client, s3_key)))
+                except Exception as e:
+                    # The download reports a missing object; just run without a checkpoint
+                    print(f"[WARN] No checkpoint for {s3_key}:", repr(e))
+            video = {"s3_key": s3_key, "run_id": run_id, "base_dir": pathlib.Path("/tmp/" + run_id),
+                     "tracer": StageTracer(run_id), "started_at": time.time(), "checkpoint": checkpoint}
+            video["base_dir"].mkdir(parents=True, exist_ok=True)
+            video["download"] = download_pool.submit(self.ingest_video, s3_key, video["base_dir"], video["tracer"])
+            return video
+
+        def render(video: dict, transcript: Transcript):
+            try:
+                result = self.render_moments(video["s3_key"], video["base_dir"], video["source"],
+                                             transcript, video["tracer"],
+                                             max_concurrent_clips=request.get("max_concurrent_clips"),
+                                             checkpoint=video["checkpoint"])
+                if video["checkpoint"] is not None and result["status"] == "ok":
+                    video["checkpoint"].clear()
+            except Exception as e:
+                return finish(video, error=e)
+            return finish(video, result=result)
+
+        report(status="running", started_at=started_at)
+        download_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch-download")
+        render_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch-render")
+        renders = []
+        processed = 0
+        try:
+            next_video = start_download(s3_keys[0]) if s3_keys else None
+            while next_video is not None:
+                video = next_video
+                processed += 1
+                next_video = None
+                if processed < len(s3_keys) and time.time() - started_at < batch_time_budget_s:
+                    # Prefetch the next source while this one is on the GPU
+                    next_video = start_download(s3_keys[processed])
+
+                try:
+                    video["source"] = video["download"].result()
+                    transcript = self.transcript_for(video["source"], video["s3_key"], video["tracer"],
+                                                     checkpoint=video["checkpoint"])
+                except Exception as e:
+                    finish(video, error=e)
+                    continue
+
+                # Keep at most one render queued behind the running one; each holds a source on disk
+                while len([future for future in renders if not future.done()]) >= 2:
+                    concurrent.futures.wait(renders, return_when=concurrent.futures.FIRST_COMPLETED)
+                renders.append(render_pool.submit(render, video, transcript))
+            concurrent.futures.wait(renders)
+        finally:
+            download_pool.shutdown(wait=True)
+            render_pool.shutdown(wait=True)
+
+        remaining = s3_keys[processed:]
+        if remaining:
+            print(f"Batch {batch_id}: time budget used, continuing with {len(remaining)} videos in a new call")
+            report(remaining=len(remaining))
+            AiPodcastClipper().run_batch.spawn(batch_id, remaining, request)
+            return jobs.get(batch_id)
+
+        record = jobs.get(batch_id) or {}
+        videos = record.get("videos", [])
+        manifest = {"batch_id": batch_id, "settings": pipeline_settings(), "videos": videos,
+                    "succeeded": sum(1 for entry in videos if entry["status"] == "succeeded"),
+                    "failed": sum(1 for entry in videos if entry["status"] == "failed")}
+        manifest_key = f"batches/{batch_id}/manifest.json"
+        try:
+            self.s3.client.put_object(Bucket=output_bucket, Key=manifest_key,
+                                      Body=json.dumps(manifest, default=str, indent=2).encode(),
+                                      ContentType="application/json")
+        except Exception as e:
+            print("[ERROR] Could not write batch manifest:", repr(e))
+            manifest_key = None
+        record = report(status="succeeded", remaining=0, manifest_s3_key=manifest_key,
+                        succeeded=manifest["succeeded"], failed=manifest["failed"], finished_at=time.time())
+        if request.get("webhook_url"):
+            record = report(webhook_status=send_webhook(request["webhook_url"], record))
+        return record
+
+
+@app.cls(cpu=render_worker_cpu, memory=render_worker_memory_mb, timeout=900, retries=0, scaledown_window=20,
+         max_containers=render_worker_max_containers,
+         secrets=[modal.Secret.from_name("ai-podcast-clipper-secret")],
+         volumes={mount_path: volume, artifacts_mount: artifacts_volume})
+class ClipRenderer:
+    """CPU-only workers for the render/burn/upload stages when STAGE_SPLIT=modal.
+
+    They autoscale on their own, so a GPU container hands a clip over after
+    ASD and goes straight on to the next one. For run_job they also record
+    the clip and finish the job (RenderHandoff), so the GPU call returns
+    without waiting for any render.
+    """
+
+    @modal.enter()
+    def load(self):
+        print(f"Using video encoder {video_encoder.name}")
+        self.s3 = S3TransferManager()
+
+    @modal.method()
+    def render(self, artifact_key: str, run_id: str | None = None, clip: dict | None = None,
+               job_id: str | None = None) -> dict:
+        # Pick up artifacts the GPU container committed after this container started
+        artifacts_volume.reload()
+        if clip is None:
+            tracer = StageTracer(run_id)
+            s3_key = render_clip_artifacts(artifact_key, transfer_manager=self.s3, tracer=tracer)
+            return {"s3_key": s3_key, "spans": tracer.spans}
+
+        tracer = StageTracer(run_id, on_span=JobReporter(job_id).on_span)
+        try:
+            clip = {**clip, "status": "ok",
+                    "s3_key": render_clip_artifacts(artifact_key, transfer_manager=self.s3, tracer=tracer)}
+        except Exception as e:
+            print(f"[ERROR] Clip {clip['index']} render failed:", repr(e))
+            clip = {**clip, "status": "error", "error": f"Render failed: {e}"}
+        RenderHandoff(run_id, job_id).record_clip(clip)
+        return clip
+
+
+@app.cls(cpu=1.0, memory=1024, timeout=60, scaledown_window=300,
+         secrets=[modal.Secret.from_name("ai-podcast-clipper-secret")])
+class JobApi:
+    """Async job endpoints on a CPU-only class.
+
+    They only touch the jobs Dict and S3 metadata (a HEAD, a batch manifest)
+    and spawn GPU work, so polling or submitting never waits on, or
+    cold-starts, an AiPodcastClipper container.
+    """
+
+    @modal.enter()
+    def connect(self):
+        self.s3_client = make_s3_client()
+
+    @modal.fastapi_endpoint(method="POST")
+    def submit_job(self, request: SubmitJobRequest, token: HTTPAuthorizationCredentials = Depends(auth_scheme)):
+        check_auth_token(token)
+
+        try:
+            source_etag = source_etag_for(self.s3_client, request.s3_key)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Could not find input video in S3: {e}")
+        job_id = job_id_for(request.s3_key, source_etag)
+        existing = jobs.get(job_id)
+        # Retries attach to a queued/running job and reuse a finished one. A job
+        # that stopped reporting (container lost) can be started again, and so can
+        # a partial one: its checkpoint makes the new attempt redo only the failed clips.
+        stale = existing and time.time() - existing.get("updated_at", 0) > job_stale_after_s
+        partial = existing and (existing.get("result") or {}).get("status") == "partial"
+        if existing and ((existing.get("status") == "succeeded" and not partial)
+                         or (existing.get("status") in ("queued", "running", "rendering") and not stale)):
+            return {"job_id": job_id, "status": existing["status"], "deduplicated": True}
+
+        attempt = existing.get("attempt", 0) + 1 if existing else 1
+        if not jobs.put(f"{job_id}:claim:{attempt}", True, skip_if_exists=True):
+            # A concurrent submit claimed this attempt first
+            current = jobs.get(job_id) or {}
+            return {"job_id": job_id, "status": current.get("status", "queued"), "deduplicated": True}
+
+        jobs[job_id] = {"job_id": job_id, "s3_key": request.s3_key, "source_etag": source_etag,
+                        "status": "queued", "attempt": attempt,
+                        "settings": pipeline_settings(), "stages": [], "clips": [],
+                        "created_at": time.time(), "updated_at": time.time()}
+        AiPodcastClipper().run_job.spawn(job_id, attempt, request.model_dump())
+        return {"job_id": job_id, "status": "queued", "deduplicated": False}
+
+    @modal.fastapi_endpoint(method="POST")
+    def submit_batch(self, request: SubmitBatchRequest, token: HTTPAuthorizationCredentials = Depends(auth_scheme)):
+        check_auth_token(token)
+
+        s3_keys = list(request.s3_keys or [])
+        if request.manifest_s3_key:
+            try:
+                body = self.s3_client.get_object(Bucket=input_bucket, Key=request.manifest_s3_key)["Body"].read()
+                s3_keys += parse_key_manifest(body)
+            except Exception as e:
+                raise HTTPException(status_code=400, detail=f"Could not read batch manifest: {e}")
+        if not s3_keys:
+            raise HTTPException(status_code=400, detail="Batch has no s3_keys")
+
+        batch_id = f"batch-{uuid.uuid4().hex}"
+        jobs[batch_id] = {"job_id": batch_id, "status": "queued", "total": len(s3_keys), "remaining": len(s3_keys),
+                          "settings": pipeline_settings(), "videos": [],
+                          "created_at": time.time(), "updated_at": time.time()}
+        AiPodcastClipper().run_batch.spawn(batch_id, s3_keys, request.model_dump())
+        return {"job_id": batch_id, "status": "queued", "total": len(s3_keys)}
+
+    @modal.fastapi_endpoint(method="GET")
+    def job_status(self, job_id: str, token: HTTPAuthorizationCredentials = Depends(auth_scheme)):
+        check_auth_token(token)
+
+        record = jobs.get(job_id)
+        if record is None:
+            raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+        return record
+
+    @modal.fastapi_endpoint(method="GET")
+    def cache_stats(self, token: HTTPAuthorizationCredentials = Depends(auth_scheme)):
+        check_auth_token(token)
+        # Counters every GPU container published, summed; per-container snapshots alongside
+        records = [record for key, record in cache_stats_store.items() if key.startswith("moment_cache:")]
+        return {"moment_cache": merge_cache_stats(records), "containers": records}
+
 
 @app.local_entrypoint()
 def main():
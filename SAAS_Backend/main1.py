@@ -2,15 +2,16 @@ import glob
 import json
 import pathlib 
 import pickle
+import random
 import shutil
 import subprocess
+import threading
 import time
 import boto3
 import uuid
 import cv2
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-import ffmpegcv
 import modal
 import numpy as np
 from pydantic import BaseModel
@@ -23,7 +24,10 @@ import requests
 from boto3.s3.transfer import TransferConfig
 import concurrent.futures
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import argparse
+from transcript import Transcript, serialize_transcript, snap_moments_to_words
+from video_encoding import FfmpegPipeWriter, VideoEncoder
 
 class ProcessVideoRequest(BaseModel):
     s3_key: str
@@ -41,6 +45,7 @@ image = (
     "fc-cache -f -v",])
     .add_local_dir("fonts", "/usr/share/fonts/truetype/custom", copy=True)  
     .add_local_dir("LR-ASD", "/LR-ASD", copy=True)
+    .add_local_python_source("transcript", "video_encoding")
 )
 
 app = modal.App("ai-SAAS", image=image)
@@ -62,6 +67,8 @@ def run_subprocess(cmd, **kwargs):
         print(f"[STDERR]\n{e.stderr}")
         raise
 
+video_encoder = VideoEncoder()
+
 def create_vertical_video(tracks, scores, pyframes_path, pyavi_path, audio_path, output_path, framerate=25):
     target_width = 1080
     target_height = 1920
@@ -100,12 +107,8 @@ def create_vertical_video(tracks, scores, pyframes_path, pyavi_path, audio_path,
             max_score_face = None
 
         if vout is None:
-            vout = ffmpegcv.VideoWriterNV(
-                file=temp_video_path,
-                codec=None,
-                fps=framerate,
-                resize=(target_width, target_height)
-            )
+            vout = FfmpegPipeWriter(temp_video_path, target_width, target_height, framerate, video_encoder,
+                                    profile="intermediate")
 
         if max_score_face:
             mode = "crop"
@@ -157,10 +160,8 @@ def create_vertical_video(tracks, scores, pyframes_path, pyavi_path, audio_path,
     if vout:
         vout.release()
 
-    # Use fast preset, reasonable bitrate, and hardware acceleration if available
-    ffmpeg_codec = "-c:v h264_nvenc" if shutil.which("nvidia-smi") else "-c:v libx264"
-    ffmpeg_command = (f"ffmpeg -y -hwaccel auto -i {temp_video_path} -i {audio_path} "
-                      f"{ffmpeg_codec} -preset fast -b:v 1M -c:a aac -b:a 128k "
+    ffmpeg_command = (f"ffmpeg -y {' '.join(video_encoder.input_args())} -i {temp_video_path} -i {audio_path} "
+                      f"{video_encoder.encode_args()} -c:a aac -b:a 128k "
                       f"{output_path}")
     run_subprocess(ffmpeg_command)
 
@@ -246,8 +247,8 @@ def create_subtitles_with_ffmpeg(transcript_segments: list, clip_start: float, c
 
     subs.save(subtitle_path)
 
-    ffmpeg_cmd = (f"ffmpeg -y -i {clip_video_path} -vf \"ass={subtitle_path}\" "
-                  f"-c:v h264 -preset fast -crf 23 {output_path}")
+    ffmpeg_cmd = (f"ffmpeg -y {' '.join(video_encoder.input_args())} -i {clip_video_path} "
+                  f"{video_encoder.encode_args([f'ass={subtitle_path}'])} {output_path}")
 
     subprocess.run(ffmpeg_cmd, shell=True, check=True)
 
@@ -281,10 +282,8 @@ def process_clip(base_dir, original_video_path, s3_key, start_time, end_time, cl
     pyavi_path.mkdir(exist_ok=True)
 
     duration = end_time - start_time
-    # Use fast preset, reasonable bitrate, and hardware acceleration if available
-    ffmpeg_codec = "-c:v h264_nvenc" if shutil.which("nvidia-smi") else "-c:v libx264"
-    cut_command = (f"ffmpeg -y -hwaccel auto -i \"{original_video_path}\" -ss {start_time} -t {duration} "
-                   f"{ffmpeg_codec} -preset fast -b:v 1M -c:a aac -b:a 128k \"{clip_segment_path}\"")
+    cut_command = (f"ffmpeg -y {' '.join(video_encoder.input_args())} -i \"{original_video_path}\" -ss {start_time} -t {duration} "
+                   f"{video_encoder.encode_args(profile='intermediate')} -c:a aac -b:a 128k \"{clip_segment_path}\"")
     run_subprocess(cut_command)
 
     extract_cmd = f"ffmpeg -y -i \"{clip_segment_path}\" -vn -acodec pcm_s16le -ar {audio_sample_rate} -ac {audio_channels} \"{audio_path}\""
@@ -352,71 +351,154 @@ def process_clip(base_dir, original_video_path, s3_key, start_time, end_time, cl
     else:
         print("[DEBUG] Skipping cleanup of intermediate files.")
 
-def chunk_transcript_words(transcript_words, chunk_duration=600):
-    """Split transcript_words (list of word dicts) into chunks of chunk_duration seconds (default 10 min)."""
+def chunk_transcript_words(transcript_words, chunk_duration=600, overlap=0):
+    """Split transcript_words (list of word dicts) into chunks of chunk_duration seconds (default 10 min).
+
+    With overlap > 0 each chunk also repeats the last `overlap` seconds of the previous one,
+    so a moment straddling a chunk boundary is seen whole by at least one request.
+    """
     chunks = []
-    current_chunk = []
-    current_start = transcript_words[0]['start'] if transcript_words else 0
-    for word in transcript_words:
-        if not current_chunk:
-            current_start = word['start']
-        current_chunk.append(word)
-        if word['end'] - current_start >= chunk_duration:
-            chunks.append(current_chunk)
-            current_chunk = []
-    if current_chunk:
-        chunks.append(current_chunk)
+    first = 0
+    while first < len(transcript_words):
+        chunk_start = transcript_words[first]['start']
+        last = first
+        while last < len(transcript_words) and transcript_words[last]['end'] - chunk_start < chunk_duration:
+            last += 1
+        last = min(last + 1, len(transcript_words))
+        chunks.append(transcript_words[first:last])
+        if last >= len(transcript_words):
+            break
+        # Step back into the chunk we just emitted, but always make progress
+        next_first = last
+        while overlap > 0 and next_first - 1 > first and transcript_words[next_first - 1]['start'] >= transcript_words[last - 1]['end'] - overlap:
+            next_first -= 1
+        first = next_first
     return chunks
 
-def select_viral_clips_with_gemini(transcript_words, gemini_model):
+gemini_max_workers = int(os.environ.get("GEMINI_MAX_WORKERS", "6"))
+gemini_requests_per_minute = int(os.environ.get("GEMINI_REQUESTS_PER_MINUTE", "60"))
+gemini_max_attempts = int(os.environ.get("GEMINI_MAX_ATTEMPTS", "4"))
+
+class RateLimiter:
+    """Spaces calls at least 60 / requests_per_minute seconds apart across threads."""
+
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+def is_retryable_gemini_error(e):
+    """Rate limits, 5xx and timeouts are worth another try; bad requests and auth errors are not."""
+    if isinstance(e, (google_exceptions.TooManyRequests, google_exceptions.ServerError, TimeoutError, ConnectionError)):
+        return True
+    code = getattr(e, "code", None)
+    return isinstance(code, int) and (code == 429 or code >= 500)
+
+def generate_with_retry(gemini_model, prompt, rate_limiter=None, attempts=gemini_max_attempts, base_delay=1.0):
+    """Call generate_content with exponential backoff (plus jitter) on retryable errors."""
+    for attempt in range(attempts):
+        if rate_limiter is not None:
+            rate_limiter.wait()
+        try:
+            return gemini_model.generate_content(prompt).text
+        except Exception as e:
+            if attempt == attempts - 1 or not is_retryable_gemini_error(e):
+                raise
+            delay = base_delay * (2 ** attempt) * (1 + random.random())
+            print(f"[WARN] Gemini call failed ({e!r}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def parse_clip_list(text):
+    """Parse a Gemini response into a list of clip dicts, tolerating ```json fences."""
+    cleaned_json_string = text.strip()
+    if cleaned_json_string.startswith("```json"):
+        cleaned_json_string = cleaned_json_string[len("```json"):].strip()
+    if cleaned_json_string.endswith("```"):
+        cleaned_json_string = cleaned_json_string[:-3].strip()
+    viral_segments = json.loads(cleaned_json_string)
+    if not isinstance(viral_segments, list):
+        raise ValueError("Gemini did not return a list")
+    return [clip for clip in viral_segments if isinstance(clip, dict) and "start" in clip and "end" in clip]
+
+def merge_viral_clips(clips):
+    """Sort clips by start and drop overlaps, keeping the longer of two overlapping clips.
+
+    Chunks overlap, so the same moment often comes back from both neighbours with
+    slightly different bounds; the longer one is the one that was not cut off.
+    """
+    merged = []
+    for clip in sorted(clips, key=lambda c: (float(c['start']), float(c['end']))):
+        if merged and float(clip['start']) < float(merged[-1]['end']):
+            previous = merged[-1]
+            if float(clip['end']) - float(clip['start']) > float(previous['end']) - float(previous['start']):
+                merged[-1] = clip
+            continue
+        merged.append(clip)
+    return merged
+
+def viral_clips_prompt(chunk):
+    return (
+        "This is a podcast video transcript. Each line is one sentence in the form start|end|text, with start and end in seconds. "
+        "I am looking to create clips between a minimum of 10 and maximum of 60 seconds long. The clip should never exceed 60 seconds.\n"
+        "Your task is to find and extract the most interesting, engaging, or highlight moments from the transcript.\n"
+        "These could be stories, jokes, strong opinions, emotional moments, or question and answer exchanges.\n"
+        "Each clip should be a self-contained moment that would be engaging for a short-form video audience.\n"
+        "It is acceptable for the clip to include a few additional sentences before or after the main moment if it aids in context.\n"
+        "Please adhere to the following rules:\n"
+        "- Ensure that clips do not overlap with one another.\n"
+        "- Start and end timestamps of the clips should align perfectly with the sentence boundaries in the transcript.\n"
+        "- Only use the start and end timestamps provided in the input. Modifying timestamps is not allowed. A clip starts at a line's start and ends at a (possibly later) line's end.\n"
+        "- Format the output as a list of JSON objects, each representing a clip with 'start' and 'end' timestamps: [{\"start\": seconds, \"end\": seconds}, ...clip2, clip3]. The output should always be readable by the python json.loads function.\n"
+        "- Aim to generate longer clips between 30-60 seconds if possible, but allow shorter (10+ seconds) if the moment is strong.\n"
+        "Avoid including:\n"
+        "- Moments of greeting, thanking, or saying goodbye.\n"
+        "If there are no valid clips to extract, the output should be an empty list [], in JSON format. Also readable by json.loads() in Python.\n"
+        f"The transcript is as follows:\n\n{serialize_transcript(Transcript.from_segments(chunk))}"
+    )
+
+def select_viral_clips_with_gemini(transcript_words, gemini_model, chunk_duration=600, overlap=60,
+                                   max_workers=gemini_max_workers, requests_per_minute=gemini_requests_per_minute):
     """
     Use Gemini to extract viral moments from the WhisperX transcript (list of word dicts), chunked for long podcasts.
-    Now works for short podcasts (5–10 min) by allowing any interesting, engaging, or highlight moments (not just Q&A/stories).
-    Returns a list of dicts: [{'start': float, 'end': float, 'label': str}, ...]
+    Chunks are sent concurrently (bounded by max_workers and requests_per_minute) and retried with backoff;
+    a chunk that still fails is logged and skipped. gemini_model is anything with generate_content(prompt).text.
+    Returns a list of non-overlapping dicts sorted by start: [{'start': float, 'end': float, ...}, ...]
     """
-    import json
-    all_viral_segments = []
-    chunks = chunk_transcript_words(transcript_words, chunk_duration=600)  # 10 min chunks
+    chunks = chunk_transcript_words(transcript_words, chunk_duration=chunk_duration, overlap=overlap)
     print(f"[DEBUG] Transcript split into {len(chunks)} chunks for Gemini processing.")
-    for i, chunk in enumerate(chunks):
-        transcript_str = " ".join([w['word'] for w in chunk])
-        prompt = (
-            "This is a podcast video transcript consisting of words, each with a start and end time. "
-            "I am looking to create clips between a minimum of 10 and maximum of 60 seconds long. The clip should never exceed 60 seconds.\n"
-            "Your task is to find and extract the most interesting, engaging, or highlight moments from the transcript.\n"
-            "These could be stories, jokes, strong opinions, emotional moments, or question and answer exchanges.\n"
-            "Each clip should be a self-contained moment that would be engaging for a short-form video audience.\n"
-            "It is acceptable for the clip to include a few additional sentences before or after the main moment if it aids in context.\n"
-            "Please adhere to the following rules:\n"
-            "- Ensure that clips do not overlap with one another.\n"
-            "- Start and end timestamps of the clips should align perfectly with the sentence boundaries in the transcript.\n"
-            "- Only use the start and end timestamps provided in the input. Modifying timestamps is not allowed.\n"
-            "- Format the output as a list of JSON objects, each representing a clip with 'start' and 'end' timestamps: [{\"start\": seconds, \"end\": seconds}, ...clip2, clip3]. The output should always be readable by the python json.loads function.\n"
-            "- Aim to generate longer clips between 30-60 seconds if possible, but allow shorter (10+ seconds) if the moment is strong.\n"
-            "Avoid including:\n"
-            "- Moments of greeting, thanking, or saying goodbye.\n"
-            "If there are no valid clips to extract, the output should be an empty list [], in JSON format. Also readable by json.loads() in Python.\n"
-            f"The transcript is as follows:\n\n{chunk}"
-        )
-        response = gemini_model.generate_content(prompt)
-        print(f"[DEBUG] Gemini raw response for chunk {i}:", response.text)
-        cleaned_json_string = response.text.strip()
-        if cleaned_json_string.startswith("```json"):
-            cleaned_json_string = cleaned_json_string[len("```json"):].strip()
-        if cleaned_json_string.endswith("```"):
-            cleaned_json_string = cleaned_json_string[:-3].strip()
-        try:
-            viral_segments = json.loads(cleaned_json_string)
+    if not chunks:
+        return []
+    rate_limiter = RateLimiter(requests_per_minute)
+
+    def select_chunk(i, chunk):
+        text = generate_with_retry(gemini_model, viral_clips_prompt(chunk), rate_limiter)
+        print(f"[DEBUG] Gemini raw response for chunk {i}:", text)
+        return parse_clip_list(text)
+
+    all_viral_segments = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as executor:
+        futures = {executor.submit(select_chunk, i, chunk): i for i, chunk in enumerate(chunks)}
+        for future in concurrent.futures.as_completed(futures):
+            i = futures[future]
+            try:
+                viral_segments = future.result()
+            except Exception as e:
+                print(f"[ERROR] Could not get viral clips for chunk {i}:", e)
+                continue
             print(f"[DEBUG] Parsed viral_segments for chunk {i}:", viral_segments)
-            if isinstance(viral_segments, list):
-                all_viral_segments.extend(viral_segments)
-            else:
-                print(f"[ERROR] Gemini did not return a list for chunk {i}.")
-        except Exception as e:
-            print(f"[ERROR] Could not parse Gemini output as JSON for chunk {i}:", e)
-            print(f"[ERROR] Gemini output was for chunk {i}:", cleaned_json_string)
-    print(f"[DEBUG] Total viral segments found: {len(all_viral_segments)}")
-    return all_viral_segments
+            all_viral_segments.extend(viral_segments)
+
+    merged = merge_viral_clips(snap_moments_to_words(all_viral_segments, Transcript.from_segments(transcript_words)))
+    print(f"[DEBUG] Total viral segments found: {len(all_viral_segments)}, {len(merged)} after merging overlaps")
+    return merged
 
 def whisperx_transcribe(audio_path: pathlib.Path) -> list:
     """
@@ -0,0 +1,116 @@
+"""Word-level transcripts and the sentence helpers moment selection builds on.
+
+Shared by main.py and main1.py so both serialize and snap moments the same way.
+"""
+import io
+from bisect import bisect_right
+
+import numpy as np
+
+
+class Transcript:
+    """Word-level transcript as parallel arrays: starts and ends in seconds plus the words.
+
+    Words are kept in start order. ends_prefix_max (running max of ends) lets
+    words_between find every word overlapping a time range with two binary
+    searches, even where WhisperX emits slightly overlapping words.
+    """
+
+    def __init__(self, starts, ends, words: list):
+        starts = np.asarray(starts, dtype=np.float64)
+        ends = np.asarray(ends, dtype=np.float64)
+        order = np.argsort(starts, kind="stable")
+        if np.any(order != np.arange(len(order))):
+            starts, ends, words = starts[order], ends[order], [words[index] for index in order]
+        self.starts = starts
+        self.ends = ends
+        self.words = [word.replace("\n", " ") for word in words]
+        self.ends_prefix_max = np.maximum.accumulate(ends) if len(ends) else ends
+
+    @classmethod
+    def from_segments(cls, segments) -> "Transcript":
+        """From WhisperX-style {start, end, word} dicts; words without timings are dropped."""
+        timed = [segment for segment in segments
+                 if segment.get("start") is not None and segment.get("end") is not None]
+        return cls([segment["start"] for segment in timed], [segment["end"] for segment in timed],
+                   [segment.get("word", "") for segment in timed])
+
+    def __len__(self):
+        return len(self.words)
+
+    def words_between(self, start: float, end: float):
+        """Indices of the words overlapping [start, end), in order."""
+        first = int(np.searchsorted(self.ends_prefix_max, start, side="right"))
+        last = int(np.searchsorted(self.starts, end, side="left"))
+        if last <= first:
+            return np.empty(0, dtype=np.int64)
+        indices = np.arange(first, last)
+        return indices[self.ends[first:last] > start]
+
+    def to_bytes(self) -> bytes:
+        """Compressed .npz: the two time arrays and the newline-joined UTF-8 words."""
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, starts=self.starts, ends=self.ends,
+                            words=np.frombuffer("\n".join(self.words).encode(), dtype=np.uint8))
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Transcript":
+        with np.load(io.BytesIO(data)) as arrays:
+            words = arrays["words"].tobytes().decode().split("\n") if len(arrays["starts"]) else []
+            return cls(arrays["starts"], arrays["ends"], words)
+
+
+def sentence_spans(transcript: Transcript, max_gap: float = 1.0, max_duration: float = 20.0):
+    """(first, last) word index pairs for each sentence.
+
+    A sentence ends on terminal punctuation, a pause longer than max_gap or once
+    it runs past max_duration (WhisperX sometimes leaves long runs unpunctuated).
+    """
+    starts, ends, words = transcript.starts.tolist(), transcript.ends.tolist(), transcript.words
+    spans = []
+    first = 0
+    for index, word in enumerate(words):
+        is_last = index == len(words) - 1
+        if (is_last or word.rstrip().endswith((".", "?", "!")) or starts[index + 1] - ends[index] > max_gap
+                or ends[index] - starts[first] >= max_duration):
+            spans.append((first, index))
+            first = index + 1
+    return spans
+
+
+def serialize_transcript(transcript: Transcript) -> str:
+    """Compact prompt encoding: one `start|end|text` line per sentence."""
+    lines = ["start|end|text"]
+    for first, last in sentence_spans(transcript):
+        text = " ".join(word.strip() for word in transcript.words[first:last + 1])
+        lines.append(f"{transcript.starts[first]:.2f}|{transcript.ends[last]:.2f}|{text}")
+    return "\n".join(lines)
+
+
+def snap_moments_to_words(moments: list, transcript: Transcript) -> list:
+    """Move each moment's start/end onto the nearest word start/end.
+
+    The prompt only carries rounded sentence times, so this maps the model's
+    answer back to the exact WhisperX timestamps. Non-dict entries pass through.
+    """
+    if not len(transcript):
+        return moments
+    starts = transcript.starts.tolist()
+    ends = sorted(transcript.ends.tolist())
+
+    def nearest(values, target):
+        position = bisect_right(values, target)
+        candidates = values[max(0, position - 1):position + 1]
+        return min(candidates, key=lambda value: abs(value - target))
+
+    snapped = []
+    for moment in moments:
+        if isinstance(moment, dict) and "start" in moment and "end" in moment:
+            try:
+                moment = {**moment, "start": nearest(starts, float(moment["start"])),
+                          "end": nearest(ends, float(moment["end"]))}
+            except (TypeError, ValueError):
+                pass
+        snapped.append(moment)
+    return snapped
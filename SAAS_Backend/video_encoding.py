@@ -0,0 +1,144 @@
+"""H.264 encoder selection and the raw-frame ffmpeg writer built on it.
+
+Shared by main.py and main1.py so every encode in either app picks the encoder
+the same way instead of hard-coding NVENC or libx264.
+"""
+import os
+import shlex
+import subprocess
+import threading
+
+import cv2
+import numpy as np
+
+# H.264 encoder for every ffmpeg encode: "auto" probes nvenc, then vaapi, then
+# libx264 once per container and keeps the first that works.
+video_encoder_preference = os.environ.get("VIDEO_ENCODER", "auto")
+# One quality target for all encoders (x264 CRF, NVENC CQ, VAAPI QP)
+video_quality = int(os.environ.get("VIDEO_QUALITY", "23"))
+vaapi_device = os.environ.get("VAAPI_DEVICE", "/dev/dri/renderD128")
+
+
+class VideoEncoder:
+    """H.264 encoder choice and the ffmpeg arguments that go with it.
+
+    The first use probes `ffmpeg -encoders` and runs a tiny test encode for each
+    candidate (NVENC, VAAPI, libx264) in that order, keeping the first that
+    works; listed is not enough, since NVENC is compiled in but fails without a
+    GPU. Every encode in main.py and main1.py builds its command from here.
+
+    Profiles: "final" is what gets uploaded; "intermediate" is re-encoded again
+    later (cut segments), so it trades size for speed at higher quality.
+    """
+
+    candidates = ("nvenc", "vaapi", "x264")
+    codecs = {"nvenc": "h264_nvenc", "vaapi": "h264_vaapi", "x264": "libx264"}
+
+    def __init__(self, preference: str = video_encoder_preference, quality: int = video_quality,
+                 concurrent_encodes: int = 1):
+        self.preference = preference
+        self.quality = quality
+        # Clips encode concurrently; split the cores instead of letting each x264 take all of them
+        self.x264_threads = max(1, (os.cpu_count() or 1) // max(1, concurrent_encodes))
+        self.lock = threading.Lock()
+        self._name = None
+
+    def listed_encoders(self) -> set:
+        try:
+            result = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], check=True, capture_output=True, text=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print("[WARN] Could not list ffmpeg encoders:", repr(e))
+            return set()
+        return {line.split()[1] for line in result.stdout.splitlines()
+                if len(line.split()) > 1 and line.startswith(" V")}
+
+    def test_encode(self, name: str) -> bool:
+        test_cmd = (["ffmpeg", "-v", "error", *self.input_args(name), "-f", "lavfi",
+                     "-i", "color=c=black:s=256x256:r=25:d=0.2", *self.filter_args([], name),
+                     *self.codec_args("final", name), "-f", "null", "-"])
+        try:
+            subprocess.run(test_cmd, check=True, capture_output=True, timeout=30)
+        except (OSError, subprocess.SubprocessError):
+            return False
+        return True
+
+    @property
+    def name(self) -> str:
+        with self.lock:
+            if self._name is None:
+                self._name = self.select()
+            return self._name
+
+    def select(self) -> str:
+        if self.preference in self.codecs:
+            return self.preference
+        listed = self.listed_encoders()
+        for name in self.candidates:
+            if name == "vaapi" and not os.path.exists(vaapi_device):
+                continue
+            if self.codecs[name] in listed and self.test_encode(name):
+                return name
+        print("[WARN] No H.264 encoder passed the test encode; using libx264")
+        return "x264"
+
+    def input_args(self, name: str | None = None) -> list:
+        """Arguments that must come before the first -i."""
+        if (name or self.name) == "vaapi":
+            return ["-vaapi_device", vaapi_device]
+        return []
+
+    def filter_args(self, filters: list, name: str | None = None) -> list:
+        """-vf for filters, with the upload to the GPU surface appended for VAAPI."""
+        filters = list(filters)
+        if (name or self.name) == "vaapi":
+            filters.append("format=nv12,hwupload")
+        return ["-vf", ",".join(filters)] if filters else []
+
+    def codec_args(self, profile: str = "final", name: str | None = None) -> list:
+        name = name or self.name
+        quality = self.quality if profile == "final" else max(0, self.quality - 5)
+        if name == "nvenc":
+            return ["-c:v", "h264_nvenc", "-preset", "p4" if profile == "final" else "p1",
+                    "-rc", "vbr", "-cq", str(quality), "-b:v", "0", "-pix_fmt", "yuv420p"]
+        if name == "vaapi":
+            return ["-c:v", "h264_vaapi", "-qp", str(quality)]
+        return ["-c:v", "libx264", "-preset", "fast" if profile == "final" else "ultrafast",
+                "-crf", str(quality), "-threads", str(self.x264_threads), "-pix_fmt", "yuv420p"]
+
+    def encode_args(self, filters: list | None = None, profile: str = "final") -> str:
+        """filter_args + codec_args, quoted for the shell-command call sites."""
+        return " ".join(shlex.quote(arg) for arg in self.filter_args(filters or []) + self.codec_args(profile))
+
+
+class FfmpegPipeWriter:
+    """Frame writer that feeds raw BGR frames to a single ffmpeg encode.
+
+    Optionally muxes an audio track and burns an ASS subtitle file in the same
+    pass, so the rendered frames are encoded exactly once.
+    """
+
+    def __init__(self, output_path, width: int, height: int, fps: float, encoder: VideoEncoder, audio_path=None,
+                 subtitle_path=None, profile: str = "final"):
+        self.width = width
+        self.height = height
+        encode_cmd = ["ffmpeg", "-y", "-v", "error", *encoder.input_args(),
+                      "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", str(fps), "-i", "-"]
+        if audio_path is not None:
+            encode_cmd += ["-i", str(audio_path)]
+        encode_cmd += encoder.filter_args([f"ass={subtitle_path}"] if subtitle_path is not None else [])
+        encode_cmd += encoder.codec_args(profile)
+        if audio_path is not None:
+            encode_cmd += ["-c:a", "aac", "-b:a", "128k"]
+        encode_cmd.append(str(output_path))
+        self.encode_cmd = encode_cmd
+        self.process = subprocess.Popen(encode_cmd, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        if frame.shape[0] != self.height or frame.shape[1] != self.width:
+            frame = cv2.resize(frame, (self.width, self.height))
+        self.process.stdin.write(np.ascontiguousarray(frame).data)
+
+    def release(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise subprocess.CalledProcessError(self.process.returncode, self.encode_cmd)